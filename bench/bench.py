@@ -0,0 +1,325 @@
+# bench.py
+# Runs a tracker, N seeders and M leechers on localhost against a generated dataset and reports
+# completion time, throughput, duplicate pieces and blocks, CPU and peak RSS as JSON.
+#
+#   python bench/bench.py --seeders 1 --leechers 4 --size 50M --files 10 --piece_length 65536 --modes 0 1
+#
+# Every process runs from its own copy of the sources in a scratch directory, so runs never touch
+# the working tree. Latency injection uses tc netem on the loopback device and needs root.
+import argparse
+import filecmp
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "common"))  # Modules shared with the other components
+import units
+
+def wait_for(condition, timeout, interval=0.1):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+def port_open(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+def generate_dataset(folder, total_size, file_count, seed):
+    # Random, incompressible files splitting total_size between them
+    os.makedirs(folder)
+    rng = random.Random(seed)
+    base, extra = divmod(total_size, file_count)
+    for index in range(file_count):
+        with open(os.path.join(folder, f"file{index}.bin"), "wb") as data_file:
+            data_file.write(rng.randbytes(base + (index < extra)))
+
+def dataset_size(dataset):
+    return sum(os.path.getsize(os.path.join(dataset, name)) for name in os.listdir(dataset))
+
+def same_files(expected, actual):
+    names = sorted(os.listdir(expected))
+    if not os.path.isdir(actual) or sorted(os.listdir(actual)) != names:
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(expected, actual, names, shallow=False)
+    return not mismatch and not errors
+
+def copy_sources(component, folder):
+    # The entry points find the shared modules in common/ next to their own folder
+    common = os.path.join(os.path.dirname(folder), "common")
+    for source, target in ((component, folder), ("common", common)):
+        if source == "common" and os.path.exists(common):
+            continue
+        os.makedirs(target)
+        for name in os.listdir(os.path.join(ROOT, source)):
+            if name.endswith(".py"):
+                shutil.copy(os.path.join(ROOT, source, name), target)
+
+class Process:
+    # A swarm process whose resource usage is collected when it exits
+    def __init__(self, name, args, cwd):
+        self.name = name
+        self.log = open(os.path.join(cwd, f"{name}.log"), "w")
+        self.popen = subprocess.Popen([sys.executable] + args, cwd=cwd, stdin=subprocess.PIPE,
+                                      stdout=self.log, stderr=subprocess.STDOUT)
+        self.usage = None
+
+    def quit(self):
+        # Seeders and leechers leave the swarm cleanly when told to on their console
+        try:
+            self.popen.stdin.write(b"quit\n")
+            self.popen.stdin.flush()
+        except OSError:
+            pass
+
+    def collect(self, timeout):
+        # os.wait4 returns the child's own rusage, which Popen.wait does not
+        if not wait_for(self._exited, timeout):
+            self.signal(signal.SIGTERM)
+            if not wait_for(self._exited, 5):
+                self.signal(signal.SIGKILL)
+                wait_for(self._exited, 5)
+        self.log.close()
+        return {
+            "cpu_user": self.usage.ru_utime if self.usage else None,
+            "cpu_system": self.usage.ru_stime if self.usage else None,
+            "max_rss_kb": self.usage.ru_maxrss if self.usage else None,
+        }
+
+    def signal(self, signum):
+        # Popen.send_signal polls the child first, which would reap it before wait4 gets its usage
+        if self.usage is None:
+            os.kill(self.popen.pid, signum)
+
+    def _exited(self):
+        if self.usage is not None:
+            return True
+        pid, status, usage = os.wait4(self.popen.pid, os.WNOHANG)
+        if pid == 0:
+            return False
+        self.usage = usage
+        self.popen.returncode = os.waitstatus_to_exitcode(status)
+        return True
+
+def rate_args(args):
+    rates = []
+    if args.link_rate:
+        # Every link is capped in its upload direction on both ends
+        rates += ["--peer_up", args.link_rate]
+    if args.up_rate:
+        rates += ["--max_up", args.up_rate]
+    if args.down_rate:
+        rates += ["--max_down", args.down_rate]
+    return rates
+
+def run_swarm(args, mode, dataset, workdir):
+    tracker_dir = os.path.join(workdir, "tracker")
+    copy_sources("tracker", tracker_dir)
+    tracker_url = f"http://127.0.0.1:{args.http_port}"
+    total_bytes = dataset_size(dataset)
+    processes = []
+    try:
+        http_server = Process("http", ["-m", "http.server", str(args.http_port), "--bind", "127.0.0.1"], tracker_dir)
+        tracker = Process("tracker", ["manager.py", "--port", str(args.tracker_port)] + args.tracker_args, tracker_dir)
+        processes += [http_server, tracker]
+        if not (wait_for(lambda: port_open(args.tracker_port), 10) and wait_for(lambda: port_open(args.http_port), 10)):
+            raise RuntimeError("Tracker did not start")
+
+        seeders = []
+        for index in range(args.seeders):
+            seeder_dir = os.path.join(workdir, f"seeder{index}")
+            copy_sources("seeder", seeder_dir)
+            # Hard links: every seeder serves the same bytes without another copy on disk
+            shutil.copytree(dataset, os.path.join(seeder_dir, "store"), copy_function=os.link)
+            seeder = Process(f"seeder{index}", ["seeder.py", "--port", str(args.seeder_port + index),
+                                                "--piece_length", str(args.piece_length),
+                                                "--tracker_url", tracker_url] + rate_args(args) + args.seeder_args, seeder_dir)
+            seeders.append((seeder, seeder_dir))
+            processes.append(seeder)
+        for index, (seeder, seeder_dir) in enumerate(seeders):
+            # The torrent file appears once hashing is done; the port opens right after
+            ready = (wait_for(lambda: os.path.exists(os.path.join(seeder_dir, "file.torrent")), args.timeout)
+                     and wait_for(lambda: port_open(args.seeder_port + index), 10))
+            if not ready:
+                raise RuntimeError(f"seeder{index} did not start")
+        torrent = os.path.join(seeders[0][1], "file.torrent") if seeders else None
+        if torrent is None:
+            raise RuntimeError("At least one seeder is needed to create the torrent")
+
+        leechers = []
+        start = time.time()
+        for index in range(args.leechers):
+            leecher_dir = os.path.join(workdir, f"leecher{index}")
+            copy_sources("leecher", leecher_dir)
+            shutil.copy(torrent, leecher_dir)
+            leecher = Process(f"leecher{index}", ["leecher.py", "--mode", str(mode), "--port", str(args.leecher_port + index),
+                                                  "--stats_json", "stats.json"] + rate_args(args) + args.leecher_args, leecher_dir)
+            leechers.append((leecher, leecher_dir))
+            processes.append(leecher)
+            time.sleep(args.stagger)
+
+        done = wait_for(lambda: all(os.path.exists(os.path.join(leecher_dir, "stats.json")) for _, leecher_dir in leechers),
+                        args.timeout, interval=0.05)
+        swarm_seconds = time.time() - start
+
+        results = []
+        for index, (leecher, leecher_dir) in enumerate(leechers):
+            stats_path = os.path.join(leecher_dir, "stats.json")
+            if not os.path.exists(stats_path):
+                results.append({"name": leecher.name, "completed": False})
+                continue
+            with open(stats_path) as stats_file:
+                stats = json.load(stats_file)
+            seconds = stats["download_seconds"]
+            results.append({
+                "name": leecher.name,
+                "completed": True,
+                "verified": same_files(dataset, os.path.join(leecher_dir, "downloads", "store")),
+                "elapsed": stats["elapsed"],
+                "download_seconds": seconds,
+                "throughput_bytes_per_second": total_bytes / seconds if seconds else None,
+                "bytes_received": stats["bytes_received"],
+                "duplicate_pieces": stats["dup"],
+                "duplicate_rate": stats["dup"] / stats["pieces"] if stats["pieces"] else 0.0,
+                "duplicate_blocks": stats["dup_blocks"],
+                "duplicate_block_rate": stats["dup_blocks"] / stats["blocks_received"] if stats["blocks_received"] else 0.0,
+                # Bytes received beyond one copy of the data, as a fraction of it
+                "overhead_rate": max(stats["bytes_received"] - total_bytes, 0) / total_bytes if total_bytes else 0.0,
+                "pieces_from": {peer: peer_stats["received"] for peer, peer_stats in stats["peers"].items()},
+                "bytes_from": {peer: peer_stats["bytes_received"] for peer, peer_stats in stats["peers"].items()},
+            })
+    finally:
+        # Leechers first, so seeders and the tracker see them leave
+        for process in reversed(processes):
+            if process.name not in ("http", "tracker"):
+                process.quit()
+        usage = {process.name: process.collect(15) for process in reversed(processes) if process.name not in ("http", "tracker")}
+        for process in processes:
+            if process.name in ("http", "tracker"):
+                process.signal(signal.SIGTERM)
+        usage.update({process.name: process.collect(5) for process in processes if process.name in ("http", "tracker")})
+
+    for result in results:
+        result.update(usage.get(result["name"], {}))
+    return {
+        "mode": mode,
+        "all_completed": done,
+        "swarm_seconds": swarm_seconds,
+        "leechers": results,
+        "processes": {name: process_usage for name, process_usage in usage.items() if not name.startswith("leecher")},
+    }
+
+def summarize(runs):
+    # Averages per mode over the repeats, for quick comparisons
+    summary = {}
+    for run in runs:
+        entry = summary.setdefault(str(run["mode"]), {"runs": 0, "swarm_seconds": 0.0, "mean_download_seconds": 0.0,
+                                                      "mean_duplicate_rate": 0.0, "mean_duplicate_block_rate": 0.0,
+                                                      "failures": 0})
+        entry["runs"] += 1
+        entry["swarm_seconds"] += run["swarm_seconds"]
+        completed = [leecher for leecher in run["leechers"] if leecher["completed"] and leecher["verified"]]
+        entry["failures"] += len(run["leechers"]) - len(completed)
+        if completed:
+            entry["mean_download_seconds"] += sum(leecher["download_seconds"] for leecher in completed) / len(completed)
+            entry["mean_duplicate_rate"] += sum(leecher["duplicate_rate"] for leecher in completed) / len(completed)
+            entry["mean_duplicate_block_rate"] += sum(leecher["duplicate_block_rate"] for leecher in completed) / len(completed)
+    for entry in summary.values():
+        for key in ("swarm_seconds", "mean_download_seconds", "mean_duplicate_rate", "mean_duplicate_block_rate"):
+            entry[key] /= entry["runs"]
+    return summary
+
+def compare(summary, baseline_path, tolerance):
+    # Returns the modes whose swarm time got slower than the baseline by more than tolerance
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["summary"]
+    regressions = []
+    for mode, entry in summary.items():
+        before = baseline.get(mode)
+        if before and entry["swarm_seconds"] > before["swarm_seconds"] * (1 + tolerance):
+            regressions.append({"mode": mode, "baseline_seconds": before["swarm_seconds"], "seconds": entry["swarm_seconds"]})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a swarm of seeders and leechers on localhost.")
+    parser.add_argument("--seeders", type=int, default=1, help="Number of seeders (default: 1).")
+    parser.add_argument("--leechers", type=int, default=3, help="Number of leechers (default: 3).")
+    parser.add_argument("--size", type=str, default="10M", help="Total dataset size, e.g. 50M (default: 10M).")
+    parser.add_argument("--files", type=int, default=5, help="Number of files the dataset is split into (default: 5).")
+    parser.add_argument("--piece_length", type=int, default=65536, help="Piece length in bytes (default: 65536).")
+    parser.add_argument("--modes", type=int, nargs="+", default=[1], help="Leecher modes to run, e.g. 0 1 (default: 1).")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per mode (default: 1).")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated dataset.")
+    parser.add_argument("--stagger", type=float, default=0.0, help="Seconds between leecher starts.")
+    parser.add_argument("--latency_ms", type=float, default=0, help="Delay added to every loopback packet with tc netem (needs root).")
+    parser.add_argument("--link_rate", type=str, default=None, help="Upload limit per peer link on every process, e.g. 2M.")
+    parser.add_argument("--up_rate", type=str, default=None, help="Total upload limit per process.")
+    parser.add_argument("--down_rate", type=str, default=None, help="Total download limit per process.")
+    parser.add_argument("--tracker_port", type=int, default=5008)
+    parser.add_argument("--http_port", type=int, default=8000)
+    parser.add_argument("--seeder_port", type=int, default=6882, help="First seeder port; seeders use consecutive ports.")
+    parser.add_argument("--leecher_port", type=int, default=7000, help="First leecher port; leechers use consecutive ports.")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for the swarm to finish.")
+    parser.add_argument("--seeder_args", type=str, default="", help="Extra arguments for every seeder, as one string.")
+    parser.add_argument("--leecher_args", type=str, default="", help="Extra arguments for every leecher, as one string.")
+    parser.add_argument("--tracker_args", type=str, default="", help="Extra arguments for the tracker, as one string.")
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report here instead of stdout.")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier report to compare against; exits 1 on a regression.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline (default: 0.2).")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory with logs and downloads.")
+    args = parser.parse_args()
+    args.seeder_args, args.leecher_args, args.tracker_args = args.seeder_args.split(), args.leecher_args.split(), args.tracker_args.split()
+
+    workroot = tempfile.mkdtemp(prefix="p2p-bench-")
+    dataset = os.path.join(workroot, "dataset")
+    generate_dataset(dataset, units.parse_size(args.size), args.files, args.seed)
+    netem = False
+    try:
+        if args.latency_ms:
+            try:
+                subprocess.run(["tc", "qdisc", "add", "dev", "lo", "root", "netem", "delay", f"{args.latency_ms}ms"], check=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                sys.exit(f"Could not add {args.latency_ms}ms of latency with tc netem (needs root and sch_netem): {e}")
+            netem = True
+        runs = []
+        for mode in args.modes:
+            for repeat in range(args.repeat):
+                workdir = os.path.join(workroot, f"mode{mode}-run{repeat}")
+                os.makedirs(workdir)
+                print(f"Running mode {mode}, run {repeat + 1}/{args.repeat} in {workdir}", file=sys.stderr)
+                runs.append(run_swarm(args, mode, dataset, workdir))
+    finally:
+        if netem:
+            subprocess.run(["tc", "qdisc", "del", "dev", "lo", "root"], check=False)
+        if not args.keep:
+            shutil.rmtree(workroot, ignore_errors=True)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "keep")}
+    config["dataset_bytes"] = units.parse_size(args.size)
+    report = {"config": config, "summary": summarize(runs), "runs": runs}
+    if args.baseline:
+        report["regressions"] = compare(report["summary"], args.baseline, args.tolerance)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(text + "\n")
+    else:
+        print(text)
+    if report.get("regressions"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import random
+import threading
+import time
+
+class Choker:
+    # Decides which interested peers may download from us. The fastest peers by recent rate get
+    # the regular upload slots, and one more slot rotates between the others (the optimistic
+    # unchoke) so newcomers get a chance to show how fast they are.
+    # rechoke() is called every choke interval; a peer that becomes interested while a slot is
+    # free is unchoked straight away rather than waiting for the next round.
+    def __init__(self, slots=4, optimistic_rounds=3):
+        self.slots = slots  # Regular upload slots
+        self.optimistic_rounds = optimistic_rounds  # Rechoke rounds between optimistic unchoke rotations
+        self.interested = set()  # Peers that want pieces from us
+        self.unchoked = set()
+        self.optimistic = None
+        self.bytes = {}  # peer -> bytes counted since the last rechoke
+        self.rates = {}  # peer -> bytes per second over the last round
+        self.rounds = 0
+        self.last_rechoke = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, peer, nbytes):
+        # Count traffic towards the peer's rate; callers pass what the peer downloaded or uploaded
+        with self.lock:
+            self.bytes[peer] = self.bytes.get(peer, 0) + nbytes
+
+    def is_unchoked(self, peer):
+        with self.lock:
+            return peer in self.unchoked
+
+    def set_interested(self, peer, interested):
+        # Returns (peers to choke, peers to unchoke) as a result
+        with self.lock:
+            if interested:
+                self.interested.add(peer)
+                return [], self._fill()
+            # A peer that wants nothing from us gives up its slot
+            self.interested.discard(peer)
+            return self._drop(peer), self._fill()
+
+    def remove(self, peer):
+        # The peer disconnected. Returns the peers to unchoke in its place.
+        with self.lock:
+            self.interested.discard(peer)
+            self.unchoked.discard(peer)
+            self.bytes.pop(peer, None)
+            self.rates.pop(peer, None)
+            if self.optimistic == peer:
+                self.optimistic = None
+            return self._fill()
+
+    def rechoke(self):
+        # Re-rank the interested peers. Returns (peers to choke, peers to unchoke).
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.last_rechoke, 1e-3)
+            self.last_rechoke = now
+            self.rates = {peer: nbytes / elapsed for peer, nbytes in self.bytes.items()}
+            self.bytes = {}
+
+            ranked = sorted(self.interested, key=lambda peer: self.rates.get(peer, 0.0), reverse=True)
+            regular = set(ranked[:self.slots])
+            if self.optimistic not in self.interested or self.optimistic in regular or self.rounds % self.optimistic_rounds == 0:
+                others = [peer for peer in ranked if peer not in regular]
+                self.optimistic = random.choice(others) if others else None
+            self.rounds += 1
+
+            unchoked = regular | ({self.optimistic} if self.optimistic else set())
+            choke = list(self.unchoked - unchoked)
+            unchoke = list(unchoked - self.unchoked)
+            self.unchoked = unchoked
+            return choke, unchoke
+
+    def _fill(self):
+        # Unchoke waiting peers while there is a free slot, counting the optimistic one
+        unchoke = []
+        waiting = [peer for peer in self.interested if peer not in self.unchoked]
+        random.shuffle(waiting)
+        while waiting and len(self.unchoked) < self.slots + 1:
+            peer = waiting.pop()
+            self.unchoked.add(peer)
+            unchoke.append(peer)
+        return unchoke
+
+    def _drop(self, peer):
+        if peer not in self.unchoked:
+            return []
+        self.unchoked.discard(peer)
+        if self.optimistic == peer:
+            self.optimistic = None
+        return [peer]
@@ -0,0 +1,201 @@
+import bisect
+import http.server
+import json
+import os
+import threading
+import time
+
+# Bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOCK_WAIT_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 0.01, 0.1, 1.0)
+HASH_BUCKETS = (1e-5, 1e-4, 1e-3, 0.01, 0.1, 1.0)
+
+def label_value(value):
+    # Peers are (ip, port) tuples; show them as ip:port
+    if isinstance(value, tuple):
+        return ":".join(str(part) for part in value)
+    return str(value)
+
+class Metric:
+    # Values are kept per tuple of label values, () when the metric has no labels
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    def label_pairs(self, label_values, extra=()):
+        pairs = [f'{name}="{label_value(value)}"' for name, value in zip(self.labels, label_values)]
+        pairs += [f'{name}="{value}"' for name, value in extra]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def retire(self, labels, into):
+        # Fold the series for labels into the one for into, e.g. once the peer it counts has gone
+        with self.lock:
+            value = self.values.pop(labels, None)
+            if value is not None:
+                self.values[into] = self.values.get(into, 0) + value
+
+class Gauge(Metric):
+    # Either set directly or read from a callback at collection time. The callback returns a
+    # number, or a dict of label values -> number for a labelled gauge.
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def collect(self):
+        if self.callback is None:
+            return super().collect()
+        value = self.callback()
+        return value if isinstance(value, dict) else {(): value}
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets, labels=()):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        with self.lock:
+            return {labels: (list(counts), total, count) for labels, (counts, total, count) in self.values.items()}
+
+class TimedLock:
+    # Stands in for a threading.Lock and records how long each acquire waited
+    def __init__(self, histogram, name):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+        self.labels = (name,)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.histogram.observe(0.0, self.labels)
+            return True
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.histogram.observe(time.perf_counter() - start, self.labels)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class Registry:
+    # The metrics of one process, rendered in the Prometheus text format or as a JSON snapshot
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), callback=None):
+        return self._add(Gauge(name, help_text, labels, callback))
+
+    def histogram(self, name, help_text, buckets, labels=()):
+        return self._add(Histogram(name, help_text, buckets, labels))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in metric.collect().items():
+                if metric.kind != "histogram":
+                    lines.append(f"{metric.name}{metric.label_pairs(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{metric.name}_bucket{metric.label_pairs(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{metric.label_pairs(labels)} {total}")
+                lines.append(f"{metric.name}_count{metric.label_pairs(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        snapshot = {"time": time.time()}
+        for metric in self.metrics:
+            entries = []
+            for labels, value in metric.collect().items():
+                entry = {"labels": {name: label_value(label) for name, label in zip(metric.labels, labels)}}
+                if metric.kind == "histogram":
+                    counts, total, count = value
+                    entry.update(count=count, sum=total, buckets=dict(zip([str(bound) for bound in metric.buckets] + ["+Inf"], counts)))
+                else:
+                    entry["value"] = value
+                entries.append(entry)
+            snapshot[metric.name] = {"type": metric.kind, "values": entries}
+        return snapshot
+
+    def serve(self, port, host="127.0.0.1"):
+        # Serve /metrics in the Prometheus text format from a background thread
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def write_snapshots(self, path, interval, exit_event):
+        # Rewrite a JSON snapshot every interval seconds, and once more on the way out
+        while True:
+            stopping = exit_event.wait(interval)
+            with open(path + ".tmp", "w") as snapshot_file:
+                json.dump(self.snapshot(), snapshot_file, indent=2)
+            os.replace(path + ".tmp", path)
+            if stopping:
+                return
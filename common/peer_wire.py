@@ -0,0 +1,353 @@
+import asyncio
+import collections
+import socket
+import struct
+import threading
+import numpy
+
+CONNECT_TIMEOUT = 10  # Seconds to wait for an outgoing connection
+MAX_QUEUED_SENDS = 64  # Messages queued for a peer before we stop reading from it
+WRITE_HIGH_WATER = 1 << 20  # Bytes buffered for a peer before we stop reading from it
+SENDFILE_MIN_SIZE = 1 << 16  # Smaller payloads, blocks included, are served from the piece cache when there is one
+
+def pack_bitfield(has):
+    # One bit per piece, piece 0 in the high bit of the first byte, as in BitTorrent
+    return numpy.packbits(has).tobytes()
+
+def unpack_bitfield(payload, piece_count):
+    # Returns a boolean array with one entry per piece
+    data = numpy.frombuffer(payload, dtype=numpy.uint8)
+    if len(data) == piece_count and piece_count > (piece_count + 7) // 8:
+        # Older peers send one byte per piece
+        return data != 0
+    return numpy.unpackbits(data, count=piece_count).astype(bool)
+
+class PeerConnection:
+    # State for one peer socket. Only touched from the event loop thread.
+    def __init__(self, peer, reader, writer):
+        self.peer = peer
+        self.reader = reader
+        self.writer = writer
+        self.send_lock = asyncio.Lock()  # Keeps multi-part messages (header + sendfile) in one piece
+        self.queued = 0  # Sends scheduled but not yet written
+        # Control messages from any thread, joined into one write at the end of the loop iteration.
+        # deque appends are atomic, so other threads can add to it without a lock.
+        self.outbox = collections.deque()
+        self.flush_scheduled = False
+        # Piece uploads waiting for the socket, keyed by (piece_index, begin) so a CANCEL can
+        # still withdraw them. They are read from disk only when their turn comes.
+        self.uploads = collections.OrderedDict()
+        self.uploading = False  # An _upload task is draining the queue
+        self.upload_room = asyncio.Event()  # Set while the upload queue is short enough to keep reading
+        self.upload_room.set()
+        self.closed = False  # Set once the read loop has ended and the peer's metrics are retired
+
+class WireEngine:
+    # Runs the peer wire protocol for every connection on a single asyncio event loop in a
+    # background thread, instead of one blocking thread per socket. Messages keep the existing
+    # framing (4-byte length, 1-byte id, payload) so threaded peers still interoperate.
+    #
+    # The handler object receives callbacks on the loop thread:
+    #   peer_connected(peer, outgoing), handle_message(peer, message_id, payload), peer_disconnected(peer)
+    # Its send/close methods are safe to call from any thread.
+    # An optional rate_limit.RateLimiter holds back piece uploads and reads from peers, and an
+    # optional metrics.Registry gets per-peer traffic counters and queue gauges.
+    def __init__(self, handler, limiter=None, metrics=None):
+        self.handler = handler
+        self.limiter = limiter
+        self.bytes_received = self.bytes_sent = None
+        if metrics:
+            self.bytes_received = metrics.counter("p2p_bytes_received_total", "Bytes read from each peer", ("peer",))
+            self.bytes_sent = metrics.counter("p2p_bytes_sent_total", "Bytes written to each peer", ("peer",))
+            metrics.gauge("p2p_connected_peers", "Open peer connections", callback=lambda: len(self.peers()))
+            metrics.gauge("p2p_upload_queue_depth", "Piece uploads waiting for each peer's socket", ("peer",),
+                          callback=self._upload_depths)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.connections = {}  # peer -> PeerConnection
+        self.connections_lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        future.result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _shutdown(self):
+        if self.server:
+            self.server.close()
+        for connection in list(self.connections.values()):
+            connection.uploads.clear()
+            connection.writer.close()
+        # Let disk reads already handed to worker threads finish, so the caller can close the
+        # piece store once stop returns
+        await self.loop.shutdown_default_executor()
+
+    def listen(self, port):
+        # Start accepting connections; returns once the listening socket is bound
+        future = asyncio.run_coroutine_threadsafe(self._listen(port), self.loop)
+        future.result()
+
+    async def _listen(self, port):
+        self.server = await asyncio.start_server(self._accept, '', port)
+
+    async def _accept(self, reader, writer):
+        peer = writer.get_extra_info('peername')[:2]
+        self._add_connection(peer, reader, writer, outgoing=False)
+
+    def dial(self, peer, callback, timeout=CONNECT_TIMEOUT):
+        # Open a connection to the peer without waiting for it; callback(peer, error) runs on the
+        # event loop once the attempt ends, with error None on success
+        future = asyncio.run_coroutine_threadsafe(self._connect(peer, timeout), self.loop)
+        future.add_done_callback(lambda future: None if future.cancelled() else callback(peer, future.exception()))
+
+    async def _connect(self, peer, timeout):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*peer), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out connecting to {peer}")
+        self._add_connection(peer, reader, writer, outgoing=True)
+
+    def _add_connection(self, peer, reader, writer, outgoing):
+        # Requests and split PIECE messages are small writes, so don't let Nagle hold them back
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = PeerConnection(peer, reader, writer)
+        with self.connections_lock:
+            self.connections[peer] = connection
+        self.handler.peer_connected(peer, outgoing)
+        self.loop.create_task(self._read_messages(connection))
+
+    async def _read_messages(self, connection):
+        try:
+            while True:
+                header = await connection.reader.readexactly(5)
+                message_length, message_id = struct.unpack("!IB", header)
+                payload = await connection.reader.readexactly(message_length - 1)
+                if self.bytes_received:
+                    self.bytes_received.inc(4 + message_length, (connection.peer,))
+                self.handler.handle_message(connection.peer, message_id, payload)
+
+                if self.limiter and self.limiter.limited("down"):
+                    # Not reading lets the socket buffers fill up, so TCP slows the sender down
+                    delay = self.limiter.delay("down", connection.peer, 4 + message_length)
+                    if delay:
+                        await asyncio.sleep(delay)
+
+                # Backpressure: stop reading from a peer while too much output to it is queued,
+                # so a peer that requests faster than it reads can't make us buffer without bound
+                transport = connection.writer.transport
+                if connection.queued > MAX_QUEUED_SENDS or transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                    async with connection.send_lock:
+                        await connection.writer.drain()
+                if len(connection.uploads) > MAX_QUEUED_SENDS:
+                    connection.upload_room.clear()
+                    await connection.upload_room.wait()
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            connection.uploads.clear()
+            with self.connections_lock:
+                if self.connections.get(connection.peer) is connection:
+                    del self.connections[connection.peer]
+            connection.writer.close()
+            if self.limiter:
+                self.limiter.forget(connection.peer)
+            connection.closed = True
+            if self.bytes_sent:
+                # Peers come and go on new ports, so fold their series into one for closed
+                # connections rather than keeping one per peer ever seen
+                self.bytes_received.retire((connection.peer,), ("closed",))
+                self.bytes_sent.retire((connection.peer,), ("closed",))
+            self.handler.peer_disconnected(connection.peer)
+
+    def peers(self):
+        with self.connections_lock:
+            return list(self.connections)
+
+    def _upload_depths(self):
+        with self.connections_lock:
+            return {(peer,): len(connection.uploads) for peer, connection in self.connections.items()}
+
+    def is_connected(self, peer):
+        with self.connections_lock:
+            return peer in self.connections
+
+    def send(self, peer, message):
+        # Queue a complete message for the peer; safe to call from any thread. Messages queued
+        # for a peer before the loop gets round to it, such as a run of REQUESTs or HAVEs, go
+        # out in a single write.
+        with self.connections_lock:
+            connection = self.connections.get(peer)
+        if connection is None:
+            return
+        connection.outbox.append(message)
+        if not connection.flush_scheduled:
+            connection.flush_scheduled = True
+            if threading.get_ident() == self.thread.ident:
+                self.loop.call_soon(self._flush, connection)
+            else:
+                self.loop.call_soon_threadsafe(self._flush, connection)
+
+    def send_piece(self, peer, header, piece_store, piece_index, begin=0, length=None):
+        # Queue a PIECE or BLOCK message whose payload (the whole piece, or length bytes of it
+        # starting at begin) comes from disk
+        if length is None:
+            length = piece_store.piece_size(piece_index) - begin
+        self._call(self._queue_upload, peer, (piece_index, begin), (header, piece_store, piece_index, begin, length))
+
+    def cancel(self, peer, piece_index, begin):
+        # Withdraw a queued upload the peer no longer wants. Uploads already handed to the
+        # socket can't be recalled, so this only helps when the peer is slow to read.
+        self._call(self._cancel_upload, peer, (piece_index, begin))
+
+    def cancel_all(self, peer):
+        # Withdraw every queued upload, e.g. when the peer is choked
+        self._call(self._cancel_all_uploads, peer)
+
+    def _call(self, callback, *args):
+        # Handlers run on the loop thread and reply from there, so skip the wakeup in that case
+        if threading.get_ident() == self.thread.ident:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _flush(self, connection):
+        # Cleared first: a message added while draining schedules another (possibly empty) flush
+        connection.flush_scheduled = False
+        messages = []
+        while connection.outbox:
+            messages.append(connection.outbox.popleft())
+        if not messages or connection.writer.is_closing():
+            return
+        data = b"".join(messages)
+        self._count_sent(connection, len(data))
+        if connection.send_lock.locked() or connection.queued:
+            # A sendfile is in progress, so wait behind it to keep the stream in order
+            self._schedule_send(connection.peer, self._write_message(data))
+        else:
+            # Buffered by the transport; the read loop applies backpressure when it grows
+            connection.writer.write(data)
+
+    def _schedule_send(self, peer, write):
+        connection = self.connections.get(peer)
+        if connection is None:
+            return
+        connection.queued += 1
+        self.loop.create_task(self._send(connection, write))
+
+    async def _send(self, connection, write):
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, so messages go out in the order they were queued
+            async with connection.send_lock:
+                await write(connection)
+        except (ConnectionError, OSError, RuntimeError):
+            # RuntimeError comes from sendfile on a transport that is already closing
+            print(f"Failed to send message to {connection.peer}")
+            connection.writer.close()
+        finally:
+            connection.queued -= 1
+
+    def _write_message(self, message):
+        async def write(connection):
+            connection.writer.write(message)
+            await connection.writer.drain()
+        return write
+
+    def _queue_upload(self, peer, key, upload):
+        connection = self.connections.get(peer)
+        if connection is None:
+            return
+        header, piece_store, piece_index, begin, length = upload
+        idle = not (connection.uploads or connection.send_lock.locked() or connection.queued)
+        if self.limiter and self.limiter.limited("up"):
+            # Uploads wait for tokens in the queue
+            idle = False
+        if idle and length < SENDFILE_MIN_SIZE and connection.writer.transport.get_write_buffer_size() == 0:
+            # Nothing is backed up, so the block would reach the socket before a CANCEL could anyway.
+            # Only a block already in memory goes out here; one that has to come from disk, with
+            # sendfile or through the piece cache, waits in the queue instead.
+            payload = piece_store.lookup(piece_index, begin, length)
+            if payload is not None:
+                self._write_block(connection, header, payload)
+                self._count_sent(connection, len(header) + length)
+                return
+        connection.uploads[key] = upload
+        if not connection.uploading:
+            connection.uploading = True
+            self.loop.create_task(self._upload(connection))
+
+    def _cancel_upload(self, peer, key):
+        connection = self.connections.get(peer)
+        if connection is not None:
+            connection.uploads.pop(key, None)
+
+    def _cancel_all_uploads(self, peer):
+        connection = self.connections.get(peer)
+        if connection is not None:
+            connection.uploads.clear()
+
+    async def _upload(self, connection):
+        try:
+            while connection.uploads:
+                _, (header, piece_store, piece_index, begin, length) = connection.uploads.popitem(last=False)
+                if len(connection.uploads) <= MAX_QUEUED_SENDS:
+                    connection.upload_room.set()
+                if self.limiter and self.limiter.limited("up"):
+                    delay = self.limiter.delay("up", connection.peer, len(header) + length)
+                    if delay:
+                        await asyncio.sleep(delay)
+                payload = None
+                if length < SENDFILE_MIN_SIZE:
+                    payload = piece_store.lookup(piece_index, begin, length)
+                    if payload is None and piece_store.loads(piece_index):
+                        # The piece cache reads it on a worker thread so the other connections carry on meanwhile
+                        payload = await self.loop.run_in_executor(None, piece_store.read_piece, piece_index, begin, length)
+                # Anything not in memory by now goes from the file to the socket with sendfile
+                async with connection.send_lock:
+                    if payload is not None:
+                        self._write_block(connection, header, payload)
+                    else:
+                        await self._write_piece(connection, header, piece_store, piece_store.piece_spans(piece_index, begin, length))
+                    self._count_sent(connection, len(header) + length)
+                    # Wait for the socket to take it, so the rest of the queue stays cancellable
+                    await connection.writer.drain()
+        except (ConnectionError, OSError, RuntimeError):
+            # RuntimeError comes from sendfile on a transport that is already closing
+            print(f"Failed to send message to {connection.peer}")
+            connection.writer.close()
+            connection.uploads.clear()
+        finally:
+            connection.uploading = False
+            connection.upload_room.set()
+
+    def _count_sent(self, connection, nbytes):
+        # Writes that race with the connection closing would bring a retired series back
+        if self.bytes_sent and not connection.closed:
+            self.bytes_sent.inc(nbytes, (connection.peer,))
+
+    def _write_block(self, connection, header, payload):
+        # A block held in memory by the piece cache. Two writes rather than writelines, which joins
+        # header and payload into a new buffer: with the write buffer empty the transport sends
+        # straight from the cached piece, and copies only what the socket does not take at once.
+        connection.writer.write(header)
+        connection.writer.write(payload)
+
+    async def _write_piece(self, connection, header, piece_store, spans):
+        connection.writer.write(header)
+        for file_index, offset, length in spans:
+            # A private file object per span, as sendfile moves the file position
+            with open(piece_store.files[file_index][0], 'rb') as piece_file:
+                await self.loop.sendfile(connection.writer.transport, piece_file, offset, length)
+
+    def close(self, peer):
+        self.loop.call_soon_threadsafe(self._close, peer)
+
+    def _close(self, peer):
+        connection = self.connections.get(peer)
+        if connection:
+            connection.writer.close()
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+
+READ_AHEAD_BYTES = 1 << 20  # Most bytes read past the piece that missed
+
+class PieceCache:
+    # Keeps recently served pieces in memory, up to capacity bytes, so a piece every peer asks
+    # for early in a swarm is read from disk once rather than once per block per peer. The
+    # least recently used pieces are evicted first. A miss also reads up to read_ahead of the
+    # following pieces (and no more than READ_AHEAD_BYTES of them) in the same pass, as peers
+    # tend to work through neighbouring pieces.
+    #
+    # Stands in for the PieceStore when handing uploads to the WireEngine. lookup only answers
+    # from memory, so the event loop never waits on the disk; on a miss the engine calls
+    # read_piece from a worker thread. Pieces large enough to go out with sendfile bypass it, as
+    # do blocks of pieces too large to cache.
+    # available(piece_index) limits read-ahead to pieces that are complete on disk.
+    def __init__(self, piece_store, capacity, read_ahead=4, available=None, metrics=None):
+        self.piece_store = piece_store
+        self.capacity = capacity
+        self.read_ahead = read_ahead
+        self.available = available
+        self.pieces = OrderedDict()  # piece_index -> bytes, least recently used first
+        self.size = 0  # Bytes held in pieces
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = None
+        if metrics:
+            self.hits = metrics.counter("p2p_piece_cache_hits_total", "Blocks served from the piece cache")
+            self.misses = metrics.counter("p2p_piece_cache_misses_total", "Blocks that had to be read from disk")
+            self.evictions = metrics.counter("p2p_piece_cache_evictions_total", "Pieces evicted to stay within the cache size")
+            metrics.gauge("p2p_piece_cache_bytes", "Bytes held in the piece cache", callback=lambda: self.size)
+
+    # The engine reads these through the cache as it would from the store
+    @property
+    def files(self):
+        return self.piece_store.files
+
+    def piece_size(self, piece_index):
+        return self.piece_store.piece_size(piece_index)
+
+    def piece_spans(self, piece_index, begin=0, length=None):
+        return self.piece_store.piece_spans(piece_index, begin, length)
+
+    def lookup(self, piece_index, begin=0, length=None):
+        # The block as a view of the cached piece, or None if the piece is not in memory
+        with self.lock:
+            piece_data = self.pieces.get(piece_index)
+            if piece_data is None:
+                return None
+            self.pieces.move_to_end(piece_index)
+        if self.hits:
+            self.hits.inc()
+        return self._slice(piece_index, piece_data, begin, length)
+
+    def loads(self, piece_index):
+        return self.piece_store.piece_size(piece_index) <= self.capacity
+
+    def read_piece(self, piece_index, begin=0, length=None):
+        # Blocks on the disk on a miss, so the engine calls this from a worker thread
+        block = self.lookup(piece_index, begin, length)
+        if block is not None:
+            return block
+        if self.misses:
+            self.misses.inc()
+        piece_size = self.piece_store.piece_size(piece_index)
+        if piece_size > self.capacity:
+            return self.piece_store.read_piece(piece_index, begin, length)
+        count = 1
+        with self.lock:
+            while (count <= self.read_ahead and piece_index + count < self.piece_store.piece_count
+                   and (count + 1) * piece_size <= self.capacity and count * piece_size <= READ_AHEAD_BYTES
+                   and piece_index + count not in self.pieces
+                   and (self.available is None or self.available(piece_index + count))):
+                count += 1
+        # The read happens outside the lock, so hits keep being served meanwhile
+        data = self.piece_store.read_pieces(piece_index, count)
+        piece_data = data[:piece_size] if count > 1 else data
+        with self.lock:
+            for offset in range(count):
+                self._add(piece_index + offset, data[offset * piece_size:(offset + 1) * piece_size] if offset else piece_data)
+        return self._slice(piece_index, piece_data, begin, length)
+
+    def _slice(self, piece_index, piece_data, begin, length):
+        if length is None:
+            length = self.piece_store.piece_size(piece_index) - begin
+        return memoryview(piece_data)[begin:begin + length]
+
+    def _add(self, piece_index, piece_data):
+        if piece_index in self.pieces:
+            # Loaded by another thread in the meantime
+            return
+        self.pieces[piece_index] = piece_data
+        self.size += len(piece_data)
+        while self.size > self.capacity:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+            if self.evictions:
+                self.evictions.inc()
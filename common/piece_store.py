@@ -0,0 +1,148 @@
+import os
+import bisect
+import threading
+
+class PieceStore:
+    # Serves pieces straight from the shared files instead of keeping them in memory.
+    # Only the file table is held in RAM; piece data is read with pread on demand.
+    # A writable store lets a leecher pwrite verified pieces at their final offsets.
+    def __init__(self, files, piece_length, writable=False):
+        self.files = files  # List of (file_path, file_length) in torrent order
+        self.piece_length = piece_length
+        self.writable = writable
+        self.fds = {}  # Lazily opened file descriptors, keyed by file index
+        self.fd_lock = threading.Lock()
+        self.seek_locks = {}  # Only used on platforms without os.pread
+
+        # The files form one continuous byte stream, so record where each of them starts
+        self.file_offsets = []
+        total_length = 0
+        for _, file_length in self.files:
+            self.file_offsets.append(total_length)
+            total_length += file_length
+        self.total_length = total_length
+        self.piece_count = -(-total_length // piece_length)
+
+    @classmethod
+    def from_folder(cls, folder_name, piece_length):
+        files = []
+        for file_name in sorted(os.listdir(folder_name)):
+            file_path = os.path.join(folder_name, file_name)
+            if os.path.isfile(file_path):
+                files.append((file_path, os.path.getsize(file_path)))
+        return cls(files, piece_length)
+
+    def piece_spans(self, piece_index, begin=0, length=None):
+        # Map a piece, or the block of it starting at begin, to the (file_index, offset, length)
+        # ranges that hold its data
+        if not 0 <= piece_index < self.piece_count:
+            raise IndexError(f"Piece {piece_index} out of range")
+        piece_size = self.piece_size(piece_index)
+        if length is None:
+            length = piece_size - begin
+        if begin < 0 or length < 0 or begin + length > piece_size:
+            raise IndexError(f"Block {begin}+{length} out of range for piece {piece_index}")
+        start = piece_index * self.piece_length + begin
+        return self._spans(start, start + length)
+
+    def _spans(self, start, end):
+        # Empty files share their offset with the next file, so take the last match
+        file_index = bisect.bisect_right(self.file_offsets, start) - 1
+        spans = []
+        # A piece can run over the end of one file into the following ones
+        while start < end:
+            offset = start - self.file_offsets[file_index]
+            length = min(end - start, self.files[file_index][1] - offset)
+            if length > 0:
+                spans.append((file_index, offset, length))
+                start += length
+            file_index += 1
+        return spans
+
+    def piece_size(self, piece_index):
+        start = piece_index * self.piece_length
+        return min(self.piece_length, self.total_length - start)
+
+    def _get_fd(self, file_index):
+        with self.fd_lock:
+            fd = self.fds.get(file_index)
+            if fd is None:
+                flags = os.O_RDWR | os.O_CREAT if self.writable else os.O_RDONLY
+                fd = os.open(self.files[file_index][0], flags | getattr(os, "O_BINARY", 0))
+                self.fds[file_index] = fd
+                self.seek_locks[file_index] = threading.Lock()
+            return fd
+
+    def _read_at(self, file_index, offset, length):
+        fd = self._get_fd(file_index)
+        chunks = []
+        while length > 0:
+            if hasattr(os, "pread"):
+                chunk = os.pread(fd, length, offset)
+            else:
+                with self.seek_locks[file_index]:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    chunk = os.read(fd, length)
+            if not chunk:
+                raise EOFError(f"{self.files[file_index][0]} is shorter than expected")
+            chunks.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return b"".join(chunks)
+
+    def read_piece(self, piece_index, begin=0, length=None):
+        return b"".join(self._read_at(file_index, offset, span_length)
+                        for file_index, offset, span_length in self.piece_spans(piece_index, begin, length))
+
+    def lookup(self, piece_index, begin=0, length=None):
+        # Nothing is held in memory, so the engine sends every upload from the files with sendfile
+        return None
+
+    def loads(self, piece_index):
+        # Whether the engine should read a piece into memory before sending it; a PieceCache does
+        return False
+
+    def read_pieces(self, first, count):
+        # The data of count consecutive pieces starting at first, read in one pass
+        if first < 0 or count <= 0 or first + count > self.piece_count:
+            raise IndexError(f"Pieces {first}..{first + count - 1} out of range")
+        start = first * self.piece_length
+        end = min(start + count * self.piece_length, self.total_length)
+        return b"".join(self._read_at(file_index, offset, span_length)
+                        for file_index, offset, span_length in self._spans(start, end))
+
+    def preallocate(self):
+        # Create every output file at its final size so pieces can be written in any order.
+        # Existing files are kept, only resized, so data already on disk survives a restart.
+        for file_path, file_length in self.files:
+            os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+            with open(file_path, "ab") as f:
+                if os.path.getsize(file_path) != file_length:
+                    f.truncate(file_length)
+
+    def _write_at(self, file_index, offset, data):
+        fd = self._get_fd(file_index)
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(fd, view, offset)
+            else:
+                with self.seek_locks[file_index]:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    written = os.write(fd, view)
+            offset += written
+            view = view[written:]
+
+    def write_piece(self, piece_index, piece_data, begin=0):
+        # Writes a whole piece, or one block of it when begin is given
+        view = memoryview(piece_data)
+        position = 0
+        for file_index, offset, length in self.piece_spans(piece_index, begin, len(view)):
+            self._write_at(file_index, offset, view[position:position + length])
+            position += length
+
+    def close(self):
+        with self.fd_lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
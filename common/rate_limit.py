@@ -0,0 +1,85 @@
+import threading
+import time
+from units import UNITS
+
+LIMITS = ("up", "down", "peer_up", "peer_down")
+MIN_BURST = 64 * 1024  # Enough for a few blocks, so limited peers still pipeline
+
+def parse_rate(text):
+    # "50M" -> bytes per second; 0 means no limit
+    text = text.strip().upper().removesuffix('/S').removesuffix('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    rate = float(text[:len(text) - len(unit)]) * UNITS[unit]
+    if rate < 0:
+        raise ValueError(f"Negative rate {text}")
+    return rate
+
+def format_rate(rate):
+    if not rate:
+        return "unlimited"
+    for unit in ('G', 'M', 'K'):
+        if rate >= UNITS[unit]:
+            return f"{rate / UNITS[unit]:.1f}{unit}/s"
+    return f"{rate:.0f}/s"
+
+class TokenBucket:
+    # Tokens are bytes, refilled at rate per second up to burst. A transfer takes its tokens up
+    # front and may leave the bucket in debt; the caller waits until the debt is paid off, which
+    # keeps the average at rate however large the transfers are.
+    def __init__(self, rate=0):
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.rate = rate  # Bytes per second, 0 for no limit
+        self.burst = max(rate / 10, MIN_BURST)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def reserve(self, nbytes):
+        # Returns the seconds to wait before the bytes may go
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class RateLimiter:
+    # Global and per-peer upload and download limits. The wire engine asks it how long to hold
+    # back each upload and each message it reads; limits can be changed while running.
+    def __init__(self, up=0, down=0, peer_up=0, peer_down=0):
+        self.limits = {"up": up, "down": down, "peer_up": peer_up, "peer_down": peer_down}
+        self.total = {"up": TokenBucket(up), "down": TokenBucket(down)}
+        self.peers = {"up": {}, "down": {}}  # direction -> peer -> TokenBucket
+        self.lock = threading.Lock()
+
+    def limited(self, direction):
+        return bool(self.limits[direction] or self.limits["peer_" + direction])
+
+    def set_limit(self, name, rate):
+        if name not in LIMITS:
+            raise KeyError(name)
+        with self.lock:
+            self.limits[name] = rate
+            if name in self.total:
+                self.total[name].set_rate(rate)
+            else:
+                for bucket in self.peers[name[len("peer_"):]].values():
+                    bucket.set_rate(rate)
+
+    def delay(self, direction, peer, nbytes):
+        # Take nbytes from the global and the peer's bucket for direction ("up" or "down")
+        with self.lock:
+            bucket = self.peers[direction].get(peer)
+            if bucket is None:
+                bucket = self.peers[direction][peer] = TokenBucket(self.limits["peer_" + direction])
+            return max(self.total[direction].reserve(nbytes), bucket.reserve(nbytes))
+
+    def forget(self, peer):
+        with self.lock:
+            for buckets in self.peers.values():
+                buckets.pop(peer, None)
+
+    def describe(self):
+        return ", ".join(f"{name} {format_rate(self.limits[name])}" for name in LIMITS)
@@ -0,0 +1,10 @@
+UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def parse_size(text):
+    # "50M" -> bytes, as a whole number
+    text = text.strip().upper().removesuffix('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    size = int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+    if size < 0:
+        raise ValueError(f"Negative size {text}")
+    return size
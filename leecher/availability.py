@@ -0,0 +1,75 @@
+import numpy
+
+class Availability:
+    # Which connected peer has which piece, kept as a boolean matrix with one row per peer and one
+    # column per piece, plus per-piece counts kept in step with it. A bitfield replaces a whole
+    # row at once, so a handshake costs a few vector operations however many pieces there are.
+    # There is no lock here: callers hold the leecher's piece_has_lock.
+    def __init__(self, piece_count, rows=8):
+        self.piece_count = piece_count
+        self.matrix = numpy.zeros((rows, piece_count), dtype=bool)
+        # Updated in place only, so the picker can keep a reference to it
+        self.counts = numpy.zeros(piece_count, dtype=numpy.int64)
+        self.version = 0  # Bumped whenever counts change, so the picker knows to re-sort
+        self.row_of = {}  # peer -> row of the matrix
+        self.peer_at_row = [None] * rows
+        self.free_rows = list(range(rows - 1, -1, -1))
+
+    def _row(self, peer):
+        row = self.row_of.get(peer)
+        if row is None:
+            if not self.free_rows:
+                # Double the matrix when every row is taken
+                rows = len(self.peer_at_row)
+                self.matrix = numpy.concatenate([self.matrix, numpy.zeros_like(self.matrix)])
+                self.peer_at_row.extend([None] * rows)
+                self.free_rows = list(range(2 * rows - 1, rows - 1, -1))
+            row = self.free_rows.pop()
+            self.row_of[peer] = row
+            self.peer_at_row[row] = peer
+        return row
+
+    def set_bitfield(self, peer, has):
+        # has is a boolean array with one entry per piece
+        row = self._row(peer)
+        self.counts -= self.matrix[row]
+        self.matrix[row] = has
+        self.counts += has
+        self.version += 1
+
+    def add_piece(self, peer, piece_index):
+        row = self._row(peer)
+        if not self.matrix[row, piece_index]:
+            self.matrix[row, piece_index] = True
+            self.counts[piece_index] += 1
+            self.version += 1
+
+    def add_pieces(self, peer, pieces):
+        # pieces is an integer array, e.g. from a HAVE_BATCH message
+        row = self._row(peer)
+        new = numpy.unique(pieces[~self.matrix[row, pieces]])
+        self.matrix[row, new] = True
+        self.counts[new] += 1
+        self.version += 1
+
+    def remove_peer(self, peer):
+        # The peer's pieces no longer count towards availability
+        row = self.row_of.pop(peer, None)
+        if row is None:
+            return
+        self.counts -= self.matrix[row]
+        self.matrix[row] = False
+        self.peer_at_row[row] = None
+        self.free_rows.append(row)
+        self.version += 1
+
+    def has(self, peer, piece_index):
+        row = self.row_of.get(peer)
+        return row is not None and bool(self.matrix[row, piece_index])
+
+    def rows(self, peers):
+        # Matrix rows of the given peers, for checking a few pieces against all of them at once
+        return [self.row_of[peer] for peer in peers if peer in self.row_of]
+
+    def peers_with(self, piece_index):
+        return [self.peer_at_row[row] for row in numpy.flatnonzero(self.matrix[:, piece_index])]
@@ -0,0 +1,115 @@
+import random
+import threading
+import time
+
+RETRY_DELAY = 5.0  # Seconds before a failed peer is tried again, doubled on each further failure
+MAX_RETRY_DELAY = 300.0
+
+class ConnectionManager:
+    # Keeps the leecher connected to up to max_peers peers. Addresses heard from the tracker go
+    # into a pool of candidates, ranked by how often dialling them has failed, and the best ones
+    # are dialled a few at a time without blocking, so a late joiner reaches its peers in one
+    # round trip instead of one connect timeout after another.
+    #
+    # Peers are known by two names: the listening address the tracker hands out, and the
+    # address of the connection itself, which for an inbound connection has an ephemeral port.
+    # The PORT message ties the two together, which is how two connections to the same peer,
+    # one dialled by each side, are spotted.
+    def __init__(self, engine, on_dialed, max_peers=50, dial_concurrency=10, dial_timeout=5.0):
+        self.engine = engine
+        self.on_dialed = on_dialed  # on_dialed(address, error) once a dial finishes
+        self.max_peers = max_peers
+        self.dial_concurrency = dial_concurrency
+        self.dial_timeout = dial_timeout
+        self.candidates = {}  # listening address -> [failures, time it may be dialled again, random tie-break]
+        self.dialing = set()
+        self.outgoing = {}  # connection address -> whether we dialled it
+        self.addresses = {}  # listening address -> connection address, once known
+        self.lock = threading.Lock()
+
+    def add_candidates(self, addresses):
+        with self.lock:
+            for address in addresses:
+                if address not in self.candidates:
+                    self.candidates[address] = [0, 0.0, random.random()]
+
+    def remove_candidates(self, addresses):
+        with self.lock:
+            for address in addresses:
+                self.candidates.pop(address, None)
+
+    def connection_for(self, address):
+        # The connection to the peer listening at address, if any
+        with self.lock:
+            if address in self.outgoing:
+                return address
+            return self.addresses.get(address)
+
+    def fill(self):
+        # Dial the best candidates while there is room under both caps
+        with self.lock:
+            room = min(self.max_peers - len(self.outgoing) - len(self.dialing),
+                       self.dial_concurrency - len(self.dialing))
+            if room <= 0:
+                return
+            now = time.time()
+            pool = [address for address, (_, retry_at, _) in self.candidates.items()
+                    if retry_at <= now and address not in self.dialing
+                    and address not in self.outgoing and address not in self.addresses]
+            pool.sort(key=lambda address: (self.candidates[address][0], self.candidates[address][2]))
+            dials = pool[:room]
+            self.dialing.update(dials)
+        for address in dials:
+            self.engine.dial(address, self._dialed, self.dial_timeout)
+
+    def _dialed(self, address, error):
+        with self.lock:
+            self.dialing.discard(address)
+            if error is not None:
+                self._back_off(address)
+        self.on_dialed(address, error)
+        self.fill()
+
+    def _back_off(self, address):
+        candidate = self.candidates.get(address)
+        if candidate is not None:
+            candidate[0] += 1
+            candidate[1] = time.time() + min(RETRY_DELAY * 2 ** (candidate[0] - 1), MAX_RETRY_DELAY)
+
+    def connected(self, peer, outgoing):
+        # Returns False if an inbound connection would go over the cap and should be closed
+        with self.lock:
+            if not outgoing and len(self.outgoing) >= self.max_peers:
+                return False
+            self.outgoing[peer] = outgoing
+            if outgoing:
+                self.addresses.setdefault(peer, peer)
+            return True
+
+    def identify(self, peer, address, their_id, my_id):
+        # The peer on connection peer listens at address. Returns a connection to close if this
+        # makes two connections to the same peer, or None.
+        with self.lock:
+            if peer not in self.outgoing:
+                return None
+            if self.outgoing[peer] and peer in self.candidates:
+                # The peer is up and talking, so forget earlier failures
+                self.candidates[peer][0] = 0
+            existing = self.addresses.get(address)
+            if existing is None or existing == peer or existing not in self.outgoing:
+                self.addresses[address] = peer
+                return None
+            # Both ends see the same pair of connections, so both keep the one dialled by the
+            # side with the lower id and agree on which to drop
+            keep_mine = my_id < their_id
+            keep = peer if self.outgoing[peer] == keep_mine else existing
+            self.addresses[address] = keep
+            return existing if keep == peer else peer
+
+    def disconnected(self, peer):
+        with self.lock:
+            if self.outgoing.pop(peer, False):
+                # A peer that dropped us, e.g. because it was full, is not dialled again right away
+                self._back_off(peer)
+            for address in [address for address, connection in self.addresses.items() if connection == peer]:
+                del self.addresses[address]
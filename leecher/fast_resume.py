@@ -0,0 +1,103 @@
+import os
+import struct
+import threading
+
+RESUME_MAGIC = b"P2PR"
+RESUME_VERSION = 2
+HEADER_FORMAT = "!4sB20sII"  # magic, version, info-hash, piece count, file count
+FILE_FORMAT = "!QQ"  # file size, mtime in nanoseconds
+
+class FastResume:
+    # Persistent piece-completion journal. The file holds a fixed-size header with the torrent's
+    # info-hash and the size and mtime of every output file, followed by a bitmap with one bit per
+    # piece. Bits are written in place as pieces verify, so an interrupted download only loses
+    # pieces that were in flight. A journal written for another torrent is ignored, even when the
+    # files have the same names and sizes.
+    def __init__(self, path, info_hash, piece_count, file_paths):
+        self.path = path
+        self.info_hash = bytes.fromhex(info_hash)
+        self.piece_count = piece_count
+        self.file_paths = file_paths
+        self.bitmap = bytearray((piece_count + 7) // 8)
+        self.bitmap_offset = struct.calcsize(HEADER_FORMAT) + len(file_paths) * struct.calcsize(FILE_FORMAT)
+        self.journal_file = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Return the pieces recorded as complete and whether the output files still have the sizes
+        # and mtimes saved with the journal. A mismatched mtime means the process did not shut down
+        # cleanly, so the caller should re-verify those pieces before trusting them.
+        try:
+            with open(self.path, "rb") as journal_file:
+                data = journal_file.read()
+        except OSError:
+            return set(), False
+        if len(data) != self.bitmap_offset + len(self.bitmap):
+            return set(), False
+        magic, version, info_hash, piece_count, file_count = struct.unpack_from(HEADER_FORMAT, data)
+        if (magic != RESUME_MAGIC or version != RESUME_VERSION or info_hash != self.info_hash
+                or piece_count != self.piece_count or file_count != len(self.file_paths)):
+            return set(), False
+
+        clean = True
+        offset = struct.calcsize(HEADER_FORMAT)
+        for file_path in self.file_paths:
+            file_size, mtime_ns = struct.unpack_from(FILE_FORMAT, data, offset)
+            offset += struct.calcsize(FILE_FORMAT)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return set(), False
+            if st.st_size != file_size:
+                # The files were replaced or truncated, nothing on disk can be trusted
+                return set(), False
+            if st.st_mtime_ns != mtime_ns:
+                clean = False
+
+        bitmap = data[self.bitmap_offset:]
+        pieces = {index for index in range(self.piece_count) if bitmap[index >> 3] & (0x80 >> (index & 7))}
+        return pieces, clean
+
+    def open(self, pieces):
+        # Start a fresh journal for the pieces we already have. The header is written with zero
+        # mtimes, so the journal only counts as clean again once save() runs.
+        for index in pieces:
+            self.bitmap[index >> 3] |= 0x80 >> (index & 7)
+        self.journal_file = open(self.path, "w+b")
+        self.journal_file.write(self._header(clean=False) + self.bitmap)
+        self.journal_file.flush()
+
+    def mark_many(self, pieces):
+        # Record a batch of verified pieces with one write covering the bitmap bytes they touch
+        if not pieces:
+            return
+        with self.lock:
+            for piece_index in pieces:
+                self.bitmap[piece_index >> 3] |= 0x80 >> (piece_index & 7)
+            first, last = min(pieces) >> 3, max(pieces) >> 3
+            if self.journal_file:
+                self.journal_file.seek(self.bitmap_offset + first)
+                self.journal_file.write(self.bitmap[first:last + 1])
+                self.journal_file.flush()
+
+    def save(self):
+        # Stamp the current file sizes and mtimes so the next start can skip re-verification
+        with self.lock:
+            if self.journal_file:
+                self.journal_file.seek(0)
+                self.journal_file.write(self._header(clean=True))
+                self.journal_file.flush()
+                os.fsync(self.journal_file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.journal_file:
+                self.journal_file.close()
+                self.journal_file = None
+
+    def _header(self, clean):
+        header = struct.pack(HEADER_FORMAT, RESUME_MAGIC, RESUME_VERSION, self.info_hash, self.piece_count, len(self.file_paths))
+        for file_path in self.file_paths:
+            st = os.stat(file_path)
+            header += struct.pack(FILE_FORMAT, st.st_size, st.st_mtime_ns if clean else 0)
+        return header
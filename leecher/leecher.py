@@ -1,30 +1,102 @@
 import socket
 import threading
-import torrent_file_process
-import pickle
 import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))  # Modules shared with the other components
+import torrent_file_process
+import piece_store
+import piece_cache
+import fast_resume
+import request_scheduler
+import piece_picker
+import choker
+import connection_manager
+import rate_limit
+import units
+import verifier
+import peer_list
+import metrics
+import availability
+import peer_wire
 import struct
 import hashlib
 import random
 import time
-
+import numpy
+import json
+try:
+    import resource  # Only for the CPU and memory figures in --stats_json; Unix only
+except ImportError:
+    resource = None
+from concurrent.futures import ThreadPoolExecutor
+
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
 BITFIELD = 4
 BITFIELD_NO_LOOP = 5
 REQUEST = 6
 PIECE = 7
 HAVE = 8
+PORT = 9
+BLOCK = 10
+CANCEL = 11
+HAVE_BATCH = 12
+
+MAX_BLOCK_SIZE = 128 * 1024  # Largest block we serve for a single REQUEST
+
+# Tracker frame types
+TRACKER_FULL = 1
+TRACKER_SAMPLE = 2
+TRACKER_JOIN = 3
+TRACKER_LEAVE = 4
+MAX_TRACKER_FRAME = 1 << 20  # Room for about 58,000 IPv6 or 174,000 IPv4 peers, far beyond any swarm here
 
 class Leecher:
-    def __init__(self, torrent_file_path, download_folder, port, random_bool, print_enabled):
+    def __init__(self, torrent_file_path, download_folder, port, print_enabled, recheck=False,
+                 max_in_flight=5, request_timeout=5.0, strategy=None, announce_interval=30.0, endgame_pieces=10,
+                 upload_slots=4, choke_interval=10.0, limiter=None, verify_workers=None,
+                 have_interval=0.1, metrics_port=None, metrics_json=None, metrics_interval=10.0,
+                 max_peers=50, dial_concurrency=10, dial_timeout=5.0, cache_size=64 << 20, read_ahead=4):
         self.torrent_file_path = torrent_file_path
         self.download_folder = download_folder
-        self.peer_list = []
-        self.random_bool = random_bool
+        self.recheck = recheck  # Re-verify pieces found in the resume journal even after a clean shutdown
+        self.peer_list = set()  # Swarm members we have heard about from the tracker
+        self.announce_interval = announce_interval  # Seconds between announces asking the tracker for more peers
+        self.strategy = strategy or "rarest"  # Piece selection: "rarest", "random" or "sequential"
         # Dictionaries for peer management and piece tracking
-        self.socket_dic = {}
-        self.bitfield_dic = {}
-        self.piece_has = {}
-        self.dup = 0
+        self.limiter = limiter or rate_limit.RateLimiter()  # Upload and download caps, changed with "rate"
+        self.metrics = metrics.Registry()  # Served over HTTP on metrics_port and/or written to metrics_json
+        self.metrics_port = metrics_port
+        self.metrics_json = metrics_json
+        self.metrics_interval = metrics_interval  # Seconds between JSON snapshots
+        self.engine = peer_wire.WireEngine(self, self.limiter, self.metrics)  # Drives every peer connection from one event loop
+        # Decides which peers we dial and drops duplicate connections to the same peer
+        self.connection_manager = connection_manager.ConnectionManager(self.engine, self.peer_dialed, max_peers,
+                                                                       dial_concurrency, dial_timeout)
+        self.node_id = random.getrandbits(64)  # Sent in PORT so two peers agree on which duplicate connection to drop
+        self.availability = None  # Which connected peer has which piece
+        self.dup = 0  # Whole pieces received or verified after we already had them
+        self.dup_blocks = 0  # Blocks nobody was waiting for any more
+        self.blocks_received = 0
+        self.bytes_received = 0  # Block payload bytes received, duplicates included
+        self.download_seconds = None  # From registering with the tracker to the last piece
+        self.completed_at = None  # When the last wanted piece was committed
+        self.max_in_flight = max_in_flight  # Outstanding requests per peer in pipelined mode
+        self.request_timeout = request_timeout  # Seconds before a stalled request is reissued
+        self.endgame_pieces = endgame_pieces  # Pieces left when outstanding blocks start going to every peer
+        self.scheduler = None
+        self.picker = None  # Availability index used to choose which piece to request next
+        self.verify_workers = verify_workers  # Threads hashing received pieces (default: one per CPU)
+        self.verifier = None
+        self.have_interval = have_interval  # Seconds HAVEs are collected for before going out as one message
+        self.pending_haves = []  # Verified pieces not announced to peers yet
+        self.have_lock = threading.Lock()
+        self.choker = choker.Choker(upload_slots)  # Which peers we upload to
+        self.choke_interval = choke_interval  # Seconds between re-rankings of the upload slots
+        self.unchoked_by = set()  # Peers that let us send them requests
+        self.interested_in = set()  # Peers we told we want pieces from, guarded by piece_has_lock
 
         self.my_pieces = set()
         if (port is None):
@@ -35,15 +107,23 @@ class Leecher:
         self.piece_length = None
         self.piece_count = 0
         self.piece_hashes = []
-        self.downloaded_pieces = {}
+        self.piece_store = None  # Verified pieces are written straight to the output files
+        self.piece_cache = None  # Recently uploaded pieces, in front of piece_store
+        self.cache_size = cache_size  # Bytes the piece cache may hold; 0 reads every block from disk
+        self.read_ahead = read_ahead  # Following pieces read along with a piece that missed the cache
+        self.fast_resume = None  # Journal of verified pieces, used to resume interrupted downloads
         self.peer_statistics = {}
 
         # Fine-grained locks for each shared structure
         self.peer_list_lock = threading.Lock()
-        self.socket_dic_lock = threading.Lock()
-        self.piece_has_lock = threading.Lock()
-        self.downloaded_pieces_lock = threading.Lock()
-        self.socket_locks = {}
+        # The two locks on the download path record how long threads wait for them
+        lock_wait = self.metrics.histogram("p2p_lock_wait_seconds", "Time spent waiting to acquire a lock",
+                                           metrics.LOCK_WAIT_BUCKETS, ("lock",))
+        self.piece_has_lock = metrics.TimedLock(lock_wait, "piece_has_lock")
+        self.downloaded_pieces_lock = metrics.TimedLock(lock_wait, "downloaded_pieces_lock")
+        self.hash_seconds = self.metrics.histogram("p2p_hash_seconds", "Time to verify one piece", metrics.HASH_BUCKETS)
+        self.request_latency = self.metrics.histogram("p2p_request_latency_seconds", "Time from sending a REQUEST to receiving its block",
+                                                      metrics.LATENCY_BUCKETS)
         self.exit_event = threading.Event()  
         self.my_pieces_lock = threading.Lock()
         self.statistics_lock = threading.Lock()
@@ -61,7 +141,40 @@ class Leecher:
         self.piece_hashes = self.metadata.piece_hashes
         self.piece_count = self.metadata.piece_count
         self.folder_name = self.metadata.folder_name
-        print(f"Parsed torrent file: {self.piece_count} pieces of size {self.piece_length}")
+        print(f"Parsed torrent file: {self.piece_count} pieces of size {self.piece_length}, info-hash {self.metadata.info_hash}")
+
+    def open_piece_store(self):
+        # Preallocate the output files so every piece can be written at its final offset
+        output_folder = os.path.join(self.download_folder, self.metadata.folder_name)
+        files = [(os.path.join(output_folder, file_info['filename']), file_info['length'])
+                 for file_info in self.metadata.files]
+        resume_path = os.path.join(self.download_folder, f"{self.metadata.folder_name}.resume")
+        self.fast_resume = fast_resume.FastResume(resume_path, self.metadata.info_hash, self.piece_count, [path for path, _ in files])
+        # Read the journal before preallocating, which would hide files that were truncated or replaced
+        resumed_pieces, clean = self.fast_resume.load()
+
+        self.piece_store = piece_store.PieceStore(files, self.piece_length, writable=True)
+        self.piece_store.preallocate()
+        # Read-ahead only picks up pieces that are verified and on disk
+        self.piece_cache = piece_cache.PieceCache(self.piece_store, self.cache_size, self.read_ahead,
+                                                  available=lambda piece_index: piece_index in self.my_pieces,
+                                                  metrics=self.metrics) if self.cache_size else self.piece_store
+        print(f"Writing downloaded files to {output_folder}")
+
+        if resumed_pieces and (self.recheck or not clean):
+            resumed_pieces = self.recheck_pieces(resumed_pieces)
+        with self.my_pieces_lock:
+            self.my_pieces = set(resumed_pieces)
+        self.fast_resume.open(resumed_pieces)
+        print(f"Resuming with {len(resumed_pieces)} / {self.piece_count} pieces already on disk")
+
+    def recheck_pieces(self, pieces):
+        # Hash the pieces already on disk in parallel and keep only the ones that still match
+        print(f"Re-verifying {len(pieces)} pieces from the resume journal")
+        pieces = sorted(pieces)
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            results = pool.map(self.verify_piece_on_disk, pieces)
+        return {piece_index for piece_index, valid in zip(pieces, results) if valid}
 
     def register_with_tracker(self):
         tracker_ip, tracker_port = torrent_file_process.get_tracker_ip_port(self.metadata)
@@ -69,30 +182,83 @@ class Leecher:
             print(f"Retrieved tracker IP: {tracker_ip}, Port: {tracker_port}")
             self.tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.tracker_socket.connect((tracker_ip, tracker_port))
-            self.tracker_socket.send(str(self.listening_port).encode())
+            self.tracker_socket.send(f"{self.listening_port} {self.metadata.info_hash}\n".encode())
             print(f"LISTENING AT: {self.listening_ip} : {self.listening_port}")
             self.init_with_peers()
             threading.Thread(target=self.receive_tracker_updates).start()
+            threading.Thread(target=self.announce).start()
         else:
             print("Failed to retrieve tracker information.")
-    
+
+    def receive_tracker_frame(self):
+        # Frames are a 4-byte length, a 1-byte type and a compact peer list
+        message_length, frame_type = struct.unpack("!IB", self._recv_exact(self.tracker_socket, 5))
+        if not 1 <= message_length <= MAX_TRACKER_FRAME:
+            # Nothing after a bad length can be trusted, so the connection is beyond saving
+            raise ConnectionError(f"Tracker frame of {message_length} bytes is out of bounds")
+        peers = peer_list.decode_peers(self._recv_exact(self.tracker_socket, message_length - 1))
+        me = (self.listening_ip, self.listening_port)
+        return frame_type, [peer for peer in peers if peer != me]
+
+    def _recv_exact(self, sock, n):
+        data = bytearray()
+        while len(data) < n:
+            packet = sock.recv(n - len(data))
+            if not packet:
+                raise ConnectionError("Connection closed unexpectedly while receiving data.")
+            data.extend(packet)
+        return data
+
     def init_with_peers(self):
+        _, peers = self.receive_tracker_frame()
         with self.peer_list_lock:
-            self.peer_list = pickle.loads(self.tracker_socket.recv(4096))
-            self.peer_list.remove((self.listening_ip, self.listening_port))
-            
-            print(f"ORIGINAL PEER LIST {self.peer_list}")
-            for peer in self.peer_list:
-                if peer != (self.listening_ip, self.listening_port):
-                    self.connect_to_peer(peer)
+            self.peer_list = set(peers)
+        print(f"ORIGINAL PEER LIST {peers}")
+        self.connection_manager.add_candidates(peers)
+        self.connection_manager.fill()
 
     def receive_tracker_updates(self):
         while not self.exit_event.is_set():
             try:
-                updated_peer_list = pickle.loads(self.tracker_socket.recv(4096))
-                updated_peer_list.remove((self.listening_ip, self.listening_port))
-                self.update_peer_list(updated_peer_list)
-            except ConnectionError:
+                frame_type, peers = self.receive_tracker_frame()
+            except (ConnectionError, OSError) as e:
+                if not self.exit_event.is_set():
+                    print(f"Lost the tracker connection: {e}")
+                    self.tracker_socket.close()
+                break
+            except ValueError as e:
+                # The frame was read whole, so the stream is still in step
+                print(f"Ignoring malformed peer list from tracker: {e}")
+                continue
+            if frame_type == TRACKER_FULL:
+                self.update_peer_list(set(peers))
+            elif frame_type == TRACKER_SAMPLE:
+                # Sampled peers we had not heard of, e.g. because a JOIN was dropped, become candidates
+                with self.peer_list_lock:
+                    self.peer_list.update(peers)
+                self.connection_manager.add_candidates(peers)
+                self.connection_manager.fill()
+            elif frame_type == TRACKER_JOIN:
+                # New peers dial the peers in their own sample, and we dial them if we have room
+                self.log(f"JOINED {peers}")
+                with self.peer_list_lock:
+                    self.peer_list.update(peers)
+                self.connection_manager.add_candidates(peers)
+                self.connection_manager.fill()
+            elif frame_type == TRACKER_LEAVE:
+                print(f"LEFT {peers}")
+                with self.peer_list_lock:
+                    self.peer_list.difference_update(peers)
+                self.connection_manager.remove_candidates(peers)
+                for peer in peers:
+                    self.remove_peer_socket(peer)
+
+    def announce(self):
+        # Periodically ask the tracker for a fresh sample of the swarm
+        while not self.exit_event.wait(self.announce_interval):
+            try:
+                self.tracker_socket.send(b"announce\n")
+            except OSError:
                 break
 
     def update_peer_list(self, updated_list):
@@ -100,56 +266,82 @@ class Leecher:
         with self.peer_list_lock:
             # Remove peers that are no longer in the list
             to_remove = [peer for peer in self.peer_list if peer not in updated_list]
-            for peer in to_remove:
-                self.remove_peer_socket(peer)
             self.peer_list = updated_list
-            
-    def remove_peer_socket(self, peer):
-        # Close the socket and remove the peer from the list and dictionary
-        with self.socket_dic_lock:
-            if peer in self.socket_dic:
-                self.socket_dic[peer].close()
-                del self.socket_dic[peer]
+        self.connection_manager.remove_candidates(to_remove)
+        # Closing sockets is I/O, so it happens outside the lock
+        for peer in to_remove:
+            self.remove_peer_socket(peer)
+        # Peers that joined since the last list are dialled like any other candidate
+        self.connection_manager.add_candidates(updated_list)
+        self.connection_manager.fill()
 
-    def connect_to_peer(self, peer):
-        try:
-            peer_socket = socket.create_connection(peer)
-            with self.socket_dic_lock:
-                self.socket_dic[peer] = peer_socket
-                # self.socket_locks[peer] = threading.Lock()
+    def remove_peer_socket(self, peer):
+        # Close the connection to the peer listening at peer, which may have dialled us, and
+        # forget what the peer had
+        connection = self.connection_manager.connection_for(peer) or peer
+        self.engine.close(connection)
+        self.forget_peer(connection)
+
+    def peer_dialed(self, peer, error):
+        if error is not None:
+            print(f"Could not connect to peer {peer} {error}")
+        elif self.engine.is_connected(peer):
             self.send_bitfield(peer)
-            # Initialize statistics for the peer
-            with self.statistics_lock:
-                self.peer_statistics[peer] = {'sent': 0, 'received': 0}
-            threading.Thread(target=self.receive_messages, args=(peer,)).start()
-        except (ConnectionRefusedError, OSError) as e:
-            print(f"Could not connect to peer {peer} {e}")
 
     def listen_for_incoming_connections(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-            server_socket.bind(('', self.listening_port))
-            server_socket.listen(10)
-            server_socket.settimeout(1)
-            print(f"Leecher listening at {self.listening_ip} {self.listening_port}")
-            
-            while not self.exit_event.is_set():
-                try:
-                    client_socket, client_address = server_socket.accept()
-                    print(f"Accepted connection from {client_address}")
-                    with self.socket_dic_lock:
-                        self.socket_dic[client_address] = client_socket
-                        self.socket_locks[client_address] = threading.Lock()
-                    with self.statistics_lock:
-                        self.peer_statistics[client_address] = {'sent': 0, 'received': 0}
-                    threading.Thread(target=self.receive_messages, args=(client_address,)).start()
-                except socket.timeout:
-                    continue
+        self.engine.listen(self.listening_port)
+        print(f"Leecher listening at {self.listening_ip} {self.listening_port}")
+
+    def peer_connected(self, peer, outgoing):
+        if not self.connection_manager.connected(peer, outgoing):
+            print(f"Refused connection from {peer}: already at {self.connection_manager.max_peers} peers")
+            self.engine.close(peer)
+            return
+        if outgoing:
+            print(f"LISTENING TO {peer}")
+        else:
+            print(f"Accepted connection from {peer}")
+        # Tell the peer where we listen, so it can tell this connection from one it dialled itself
+        self._send_message(peer, struct.pack("!IBHQ", 11, PORT, self.listening_port, self.node_id))
+        # Initialize statistics for the peer
+        with self.statistics_lock:
+            self.peer_statistics[peer] = {'sent': 0, 'received': 0, 'bytes_received': 0}
+
+    def peer_disconnected(self, peer):
+        print(f"Connection with {peer} CLOSED")
+        self.connection_manager.disconnected(peer)
+        self.forget_peer(peer)
+        self.unchoked_by.discard(peer)
+        with self.piece_has_lock:
+            self.interested_in.discard(peer)
+        # Hand its upload slot to someone else
+        self.apply_choke([], self.choker.remove(peer))
+
+    def run_choker(self):
+        # Re-rank peers: by how fast they upload to us while we download, then by how fast we
+        # upload to them once we only seed
+        while not self.exit_event.wait(self.choke_interval):
+            self.apply_choke(*self.choker.rechoke())
+
+    def apply_choke(self, choke, unchoke):
+        for peer in choke:
+            self._send_message(peer, struct.pack("!IB", 1, CHOKE))
+            # Requests from a choked peer are discarded, including those still queued
+            self.engine.cancel_all(peer)
+            self.log(f"CHOKED {peer}")
+        for peer in unchoke:
+            self._send_message(peer, struct.pack("!IB", 1, UNCHOKE))
+            self.log(f"UNCHOKED {peer}")
+
+    def send_interest(self, peer, interested):
+        self._send_message(peer, struct.pack("!IB", 1, INTERESTED if interested else NOT_INTERESTED))
+        self.log(f"SENT {'INTERESTED' if interested else 'NOT INTERESTED'} to {peer}")
 
     def send_bitfield(self, peer, loop = True):
-        bitfield_payload = bytearray(self.piece_count)
+        has = numpy.zeros(self.piece_count, dtype=bool)
         with self.my_pieces_lock:
-            for index in self.my_pieces:
-                bitfield_payload[index] = 1
+            has[numpy.fromiter(self.my_pieces, dtype=numpy.int64, count=len(self.my_pieces))] = True
+        bitfield_payload = peer_wire.pack_bitfield(has)
         self.log(f"SEND BD to {peer}")
         if loop:
             message = struct.pack("!IB", 1 + len(bitfield_payload), BITFIELD) + bitfield_payload
@@ -157,287 +349,394 @@ class Leecher:
             message = struct.pack("!IB", 1 + len(bitfield_payload), BITFIELD_NO_LOOP) + bitfield_payload
         self._send_message(peer, message)
 
-    def receive_messages(self, peer):
-        peer_socket = self.socket_dic[peer]
-        print(f"LISTENING TO {peer}")
-        while not self.exit_event.is_set():
-            try:
-                header = peer_socket.recv(5)
-                if len(header) < 5:
-                    break
-                message_length, message_id = struct.unpack("!IB", header)
-                data = self._recv_exact(peer_socket, message_length - 1)
-
-                if message_id == BITFIELD:  # Bitfield message
-                    self.receive_bitfield(peer, data)
-                    self.send_bitfield(peer, loop=False)
-                elif message_id == BITFIELD_NO_LOOP:
-                    self.receive_bitfield(peer, data)
-                elif message_id == REQUEST:  # Request message
-                    piece_index, = struct.unpack("!I", data)
-                    self.send_piece(peer, piece_index)
-                elif message_id == PIECE:  # Piece message
-                    piece_index = struct.unpack("!I", data[:4])[0]
-                    piece_data = data[4:]
-                    self.process_piece(piece_index, piece_data, peer)
-                elif message_id == HAVE:
-                    piece_index, = struct.unpack("!I", data)
-                    self.process_have_message(peer, piece_index)
-            except (BrokenPipeError, ConnectionResetError):
-                print(f"Connection with {peer} lost")
-                break
-            except OSError as e:
-                print(f"Connection with {peer} CLOSED")
+    def handle_message(self, peer, message_id, data):
+        # Called on the engine's event loop for every message a peer sends
+        if message_id == BITFIELD:  # Bitfield message
+            self.receive_bitfield(peer, data)
+            self.send_bitfield(peer, loop=False)
+        elif message_id == BITFIELD_NO_LOOP:
+            self.receive_bitfield(peer, data)
+        elif message_id == CHOKE:
+            # The peer drops whatever we asked for, so those blocks have to go elsewhere
+            self.unchoked_by.discard(peer)
+            self.scheduler.drop_peer(peer)
+            self.log(f"CHOKED BY {peer}")
+        elif message_id == UNCHOKE:
+            self.unchoked_by.add(peer)
+            self.log(f"UNCHOKED BY {peer}")
+            self.fill_requests([peer])
+        elif message_id == INTERESTED:
+            self.apply_choke(*self.choker.set_interested(peer, True))
+        elif message_id == NOT_INTERESTED:
+            self.apply_choke(*self.choker.set_interested(peer, False))
+        elif message_id == REQUEST and not self.choker.is_unchoked(peer):
+            self.log(f"IGNORED REQUEST FROM CHOKED {peer}")
+        elif message_id == REQUEST:  # Request message
+            if len(data) == 12:
+                piece_index, begin, length = struct.unpack("!III", data)
+                self.send_piece(peer, piece_index, begin, length)
+            else:
+                # Older peers ask for whole pieces
+                piece_index, = struct.unpack("!I", data)
+                self.send_piece(peer, piece_index)
+        elif message_id == CANCEL:
+            piece_index, begin, length = struct.unpack("!III", data)
+            self.engine.cancel(peer, piece_index, begin)
+            self.log(f"CANCELLED {piece_index}+{begin} FOR {peer}")
+        elif message_id == BLOCK:
+            piece_index, begin = struct.unpack("!II", data[:8])
+            self.process_block(piece_index, begin, data[8:], peer)
+        elif message_id == PIECE:  # Piece message
+            piece_index = struct.unpack("!I", data[:4])[0]
+            self.process_block(piece_index, 0, data[4:], peer)
+        elif message_id == HAVE:
+            piece_index, = struct.unpack("!I", data)
+            self.process_have_message(peer, piece_index)
+        elif message_id == HAVE_BATCH:
+            self.process_have_batch(peer, numpy.frombuffer(data, dtype=">u4").astype(numpy.int64))
+        elif message_id == PORT:
+            port, node_id = struct.unpack("!HQ", data)
+            self.identify_peer(peer, port, node_id)
+
+    def identify_peer(self, peer, port, node_id):
+        if node_id == self.node_id:
+            # We dialled one of our own addresses
+            self.connection_manager.remove_candidates([peer])
+            self.engine.close(peer)
+            return
+        duplicate = self.connection_manager.identify(peer, (peer[0], port), node_id, self.node_id)
+        if duplicate is not None:
+            self.log(f"CLOSING DUPLICATE CONNECTION {duplicate} TO {(peer[0], port)}")
+            self.engine.close(duplicate)
+
+    def forget_peer(self, peer):
+        # Requests still outstanding on this connection will never be answered
+        self.scheduler.drop_peer(peer)
+        # The peer's pieces no longer count towards availability
+        with self.piece_has_lock:
+            self.availability.remove_peer(peer)
 
     def process_have_message(self, peer, piece_index):
-        # Update bitfield_dic with the new piece for the peer
         self.log(f"{peer} has {piece_index}")
         with self.piece_has_lock:
-            if peer in self.bitfield_dic:
-                # Update the peer's bitfield to indicate they have this piece
-                bitfield = bytearray(self.bitfield_dic[peer])
-                bitfield[piece_index] = 1
-                self.bitfield_dic[peer] = bitfield
-            else:
-                # Initialize the bitfield if it doesn't exist
-                self.bitfield_dic[peer] = bytearray(self.piece_count)
-                self.bitfield_dic[peer][piece_index] = 1
-
-        # Update the piece_has dictionary to add the peer to the list of peers with this piece
+            self.availability.add_piece(peer, piece_index)
+            interesting = self.picker.wanted[piece_index] and peer not in self.interested_in
+            if interesting:
+                self.interested_in.add(peer)
+        if interesting:
+            self.send_interest(peer, True)
+
+    def process_have_batch(self, peer, pieces):
+        # Several pieces announced at once: one availability update for the lot
+        pieces = pieces[pieces < self.piece_count]
+        self.log(f"{peer} has {len(pieces)} more pieces")
         with self.piece_has_lock:
-            if piece_index not in self.piece_has:
-                self.piece_has[piece_index] = []
-            if peer not in self.piece_has[piece_index]:
-                self.piece_has[piece_index].append(peer)
-
-    def send_piece(self, peer, piece_index):
-        
-        with self.downloaded_pieces_lock:
-            # Check if the requested piece is available
-            if piece_index in self.downloaded_pieces:
-                with self.piece_has_lock:
-                    peer_bitfield = self.bitfield_dic.get(peer, bytearray(self.piece_count))
-                    if peer_bitfield[piece_index] == 1:
-                        print(f"{peer} HAD {piece_index} NO SEND")
-                        return
-                piece_data = self.downloaded_pieces[piece_index]
-                # Construct the piece message: length, ID=7, piece_index, and piece_data
-                message = struct.pack("!IBI", 5 + len(piece_data), PIECE, piece_index) + piece_data
-                # Send the piece message
-                self._send_message(peer, message)
-                self.log(f"SENT PIECE {piece_index} TO {peer}")
-                with self.statistics_lock:
-                    self.peer_statistics[peer]['sent'] += 1
-            else:
-                # Log that the requested piece is not available
-                print(f"Requested piece {piece_index} not available for {peer}")
-
-    def _recv_exact(self, sock, n):
-        data = bytearray()
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                raise ConnectionError("Connection closed unexpectedly while receiving data.")
-            data.extend(packet)
-        return data
+            self.availability.add_pieces(peer, pieces)
+            interesting = bool(self.picker.wanted[pieces].any()) and peer not in self.interested_in
+            if interesting:
+                self.interested_in.add(peer)
+        if interesting:
+            self.send_interest(peer, True)
+
+    def send_piece(self, peer, piece_index, begin=None, length=None):
+        # Check if the requested piece is available
+        with self.my_pieces_lock:
+            available = piece_index in self.my_pieces
+        if available and begin is not None:
+            available = 0 < length <= MAX_BLOCK_SIZE and begin + length <= self.piece_store.piece_size(piece_index)
+        if not available:
+            # Log that the requested piece is not available
+            print(f"Requested piece {piece_index} not available for {peer}")
+            return
+        with self.piece_has_lock:
+            if self.availability.has(peer, piece_index):
+                print(f"{peer} HAD {piece_index} NO SEND")
+                return
+        if begin is None:
+            # Send the header (length, ID=7, piece_index), then the payload from the cache or disk
+            header = struct.pack("!IBI", 5 + self.piece_store.piece_size(piece_index), PIECE, piece_index)
+        else:
+            # Send the header (length, ID=10, piece_index, begin), then the block from the cache or disk
+            header = struct.pack("!IBII", 9 + length, BLOCK, piece_index, begin)
+        self.engine.send_piece(peer, header, self.piece_cache, piece_index, begin or 0, length)
+        if self.picker.remaining() == 0:
+            self.choker.record(peer, len(header) + (length or self.piece_store.piece_size(piece_index)))
+        self.log(f"SENT PIECE {piece_index} TO {peer}")
+        with self.statistics_lock:
+            self.peer_statistics[peer]['sent'] += 1
 
     def receive_bitfield(self, peer, bitfield):
-        self.log(f"RECEIVED BD {bitfield} FROM {peer}")
+        has = peer_wire.unpack_bitfield(bitfield, self.piece_count)
+        self.log(f"RECEIVED BD WITH {int(has.sum())} PIECES FROM {peer}")
         with self.piece_has_lock:
-            self.bitfield_dic[peer] = bitfield
-            for piece_index, has_piece in enumerate(bitfield):
-                if has_piece:
-                    self.update_peer_piece_info(peer, piece_index)
-
-    def update_peer_piece_info(self, peer, piece_index):
-        if piece_index not in self.piece_has:
-            self.piece_has[piece_index] = []
-        if peer not in self.piece_has[piece_index]:
-            self.piece_has[piece_index].append(peer)
+            self.availability.set_bitfield(peer, has)
+            interesting = bool((has & self.picker.wanted).any())
+            if interesting:
+                self.interested_in.add(peer)
+        if interesting:
+            self.send_interest(peer, True)
 
     def _send_message(self, peer, message):
-        with self.socket_dic_lock:
-            peer_socket = self.socket_dic.get(peer)
-        if peer_socket:
-            try:
-                peer_socket.sendall(message)
-            except (BrokenPipeError, ConnectionResetError):
-                print(f"Failed to send message to {peer}")
-
-    def request_piece(self, piece_index):
+        self.engine.send(peer, message)
+
+    def fill_requests(self, peers=None):
+        # Top up the request window of the given peers (all connected peers by default)
+        if peers is None:
+            peers = self.engine.peers()
+        # Only peers that unchoked us will answer
+        peers = [peer for peer in peers if peer in self.unchoked_by]
+        if not peers:
+            return
         with self.piece_has_lock:
-            peers_with_piece = self.piece_has.get(piece_index, [])
-        self.log(f"LIST: {peers_with_piece} has {piece_index}")
-        if peers_with_piece:
-            peer = random.choice(peers_with_piece)
-            message = struct.pack("!IBI", 5, 6, piece_index)
-            self._send_message(peer, message)
-            self.log(f"SENT REQUEST {piece_index} to {peer}")
+            if not self.scheduler.endgame and self.picker.remaining() <= self.endgame_pieces:
+                self.scheduler.endgame = True
+                print(f"ENDGAME WITH {self.picker.remaining()} PIECES LEFT")
+            # Only consider pieces these peers can actually serve
+            candidates = self.picker.candidates(peers)
+            requests = self.scheduler.next_requests(peers, candidates, self.availability.peers_with)
+        for peer, piece_index, begin, length in requests:
+            self.request_piece(peer, piece_index, begin, length)
+
+    def request_piece(self, peer, piece_index, begin, length):
+        message = struct.pack("!IBIII", 13, REQUEST, piece_index, begin, length)
+        self._send_message(peer, message)
+        self.log(f"SENT REQUEST {piece_index} to {peer}")
 
-    def process_piece(self, piece_index, piece_data, peer):
-        if (piece_index in self.my_pieces):
+    def cancel_request(self, peer, piece_index, begin):
+        length = self.scheduler.block_length(piece_index, begin)
+        message = struct.pack("!IBIII", 13, CANCEL, piece_index, begin, length)
+        self._send_message(peer, message)
+        self.log(f"SENT CANCEL {piece_index}+{begin} to {peer}")
+
+    def process_block(self, piece_index, begin, block_data, peer):
+        complete, duplicates = self.scheduler.block_received(piece_index, begin, len(block_data), peer)
+        self.blocks_received += 1
+        self.bytes_received += len(block_data)
+        with self.statistics_lock:
+            self.peer_statistics[peer]['bytes_received'] += len(block_data)
+        self.choker.record(peer, len(block_data))
+        # In endgame the block may also have been requested from other peers
+        for other in duplicates:
+            self.cancel_request(other, piece_index, begin)
+        if complete is None:
+            # Not a block we are waiting for, e.g. the late answer to a request that timed out
+            self.dup_blocks += 1
+        elif len(block_data) == self.piece_store.piece_size(piece_index):
+            # The piece fits in one block, so verify it without a round trip through the disk
+            self.store_piece(piece_index, block_data, peer)
+        else:
+            # Park the block at its final offset; the piece is verified once every block is in
+            self.piece_store.write_piece(piece_index, block_data, begin)
+            if complete:
+                self.store_piece(piece_index, None, peer)
+        # Top the peer's window up once it has drained to the low-water mark, so requests go
+        # out in small batches rather than one candidate search per block
+        if self.scheduler.needs_requests(peer):
+            self.fill_requests([peer])
+
+    def store_piece(self, piece_index, piece_data, peer):
+        # Hand the piece to the verifier; commit_pieces records it once its hash checks out.
+        # piece_data is None when its blocks have already been written and the piece has to be
+        # verified from disk.
+        if piece_index in self.my_pieces:
             self.dup += 1
+            self.scheduler.piece_checked(piece_index)
             return
+        self.verifier.submit(piece_index, piece_data, peer)
+
+    def check_piece(self, piece_index, piece_data):
+        # Runs on a verifier thread
+        start = time.perf_counter()
+        if piece_data is None:
+            valid = self.verify_piece_on_disk(piece_index)
+        else:
+            valid = self.verify_piece(piece_index, piece_data)
+        self.hash_seconds.observe(time.perf_counter() - start)
+        return valid
+
+    def commit_pieces(self, batch):
+        # Runs on the verifier's commit thread with the pieces hashed since the last batch
+        verified = []
+        for piece_index, piece_data, peer, valid in batch:
+            if not valid:
+                self.log(f"{piece_index} NOT VALID")
+                continue
+            if piece_data is not None:
+                # Write the verified piece through to disk instead of keeping it in memory
+                self.piece_store.write_piece(piece_index, piece_data)
+            verified.append((piece_index, peer))
+
+        committed = []
+        pieces = set()
         with self.downloaded_pieces_lock:
-            self.downloaded_pieces[piece_index] = piece_data
+            for piece_index, peer in verified:
+                # Another peer may have delivered the same piece while this one was being verified
+                if piece_index in self.my_pieces or piece_index in pieces:
+                    self.dup += 1
+                else:
+                    committed.append((piece_index, peer))
+                    pieces.add(piece_index)
+            # Journal first, so the download never looks finished before it is recorded
+            self.fast_resume.mark_many(pieces)
+            with self.my_pieces_lock:
+                self.my_pieces.update(pieces)
+            with self.piece_has_lock:
+                for piece_index in pieces:
+                    self.picker.piece_done(piece_index)
+                if pieces and self.picker.remaining() == 0:
+                    self.completed_at = time.time()
             with self.statistics_lock:
-                self.peer_statistics[peer]['received'] += 1
+                for _, peer in committed:
+                    self.peer_statistics[peer]['received'] += 1
+
+        # Pieces that failed start again with every block missing
+        for piece_index, _, _, _ in batch:
+            self.scheduler.piece_checked(piece_index)
+        for piece_index, peer in committed:
             self.log(f"DOWNLOADED {piece_index} FROM {peer}")
-        # piece_path = os.path.join(self.download_folder, f"piece_{piece_index}")
-        # with open(piece_path, "wb") as piece_file:
-        #     piece_file.write(piece_data)
-        if self.verify_piece(piece_index, piece_data):
-            with self.my_pieces_lock:
-                self.my_pieces.add(piece_index)
-            self.broadcast_have(piece_index)
-        else:
-            self.log(f"{piece_index} NOT VALID")
+        self.broadcast_haves(pieces)
+
     def verify_piece(self, piece_index, piece_data):
         expected_hash = self.piece_hashes[piece_index]
-        actual_hash = hashlib.sha1(piece_data).hexdigest()
+        actual_hash = hashlib.sha1(piece_data).digest()
         return actual_hash == expected_hash
 
-    def broadcast_have(self, piece_index):
-        with self.peer_list_lock:
-            for peer in self.peer_list:
-                message = struct.pack("!IBI", 5, HAVE, piece_index)
-                self._send_message(peer, message)
-                self.log(f"SENT HAVE {piece_index} to {peer}")
+    def verify_piece_on_disk(self, piece_index):
+        # Hash the piece back from disk a block at a time, so large pieces never sit in memory
+        piece_hash = hashlib.sha1()
+        piece_size = self.piece_store.piece_size(piece_index)
+        for begin in range(0, piece_size, request_scheduler.BLOCK_SIZE):
+            length = min(request_scheduler.BLOCK_SIZE, piece_size - begin)
+            piece_hash.update(self.piece_store.read_piece(piece_index, begin, length))
+        return piece_hash.digest() == self.piece_hashes[piece_index]
+
+    def broadcast_haves(self, pieces):
+        # Queue the pieces for the next HAVE announcement
+        with self.have_lock:
+            self.pending_haves.extend(pieces)
+        if not self.have_interval:
+            self.flush_haves()
+
+    def send_haves(self):
+        while not self.exit_event.wait(self.have_interval):
+            self.flush_haves()
+
+    def flush_haves(self):
+        # Everything verified since the last flush goes to each peer as one message
+        with self.have_lock:
+            pieces, self.pending_haves = self.pending_haves, []
+        if not pieces:
+            return
+        if len(pieces) == 1:
+            message = struct.pack("!IBI", 5, HAVE, pieces[0])
+        else:
+            payload = numpy.array(pieces, dtype=">u4").tobytes()
+            message = struct.pack("!IB", 1 + len(payload), HAVE_BATCH) + payload
+        for peer in self.engine.peers():
+            self._send_message(peer, message)
+            self.log(f"SENT HAVE FOR {len(pieces)} PIECES to {peer}")
 
     def download_pieces(self):
-        piece_indexes = list(range(self.piece_count))
-        i = 0
+        # Requests are driven by the scheduler: new ones go out as pieces arrive, and this loop
+        # only reissues stalled requests and picks up peers or pieces that became available
         print("START SENDING REQUEST")
-        while i < 30:
-            i += 1
-            
-            with self.my_pieces_lock:
-                not_downloaded_set = set(piece_indexes) - self.my_pieces
-
-            print(f"ITERATION {i}: PIECE NOT DOWNLOADED {len(not_downloaded_set)}")
-            if len(not_downloaded_set) == 0:
-                break
-
-            not_downloaded_list = list(not_downloaded_set)
-            if self.random_bool:
-                random.shuffle(not_downloaded_list)
-
-            for piece_index in not_downloaded_list:
-                # Double-check under lock before requesting a piece
-                check = True
-                with self.my_pieces_lock:
-                    check = piece_index not in self.my_pieces
-                if check:
-                    self.request_piece(piece_index)
-                else:
-                    self.log("ERROR DOWNLOAD PIECES")
-            time.sleep(float(len(not_downloaded_set)) / 10000)
-
-
-        print("SENT ALL REQUEST")
-        while len(self.downloaded_pieces) < self.piece_count:
-            not_downloaed_set = set(range(self.piece_count)) - self.my_pieces
-            time.sleep(0.5)
-            print(f"DOWNLOADING {len(self.downloaded_pieces)} / {self.piece_count}", end = '\r')
-            print(f"NOT DOWNLOADED {not_downloaed_set}")
-        print(f"DOWNLOADING {len(self.downloaded_pieces)} / {self.piece_count}", end = '\r')
+        while self.picker.remaining() > 0 and not self.exit_event.is_set():
+            for peer, piece_index, begin in self.scheduler.expire():
+                self.log(f"REQUEST {piece_index}+{begin} TO {peer} TIMED OUT")
+                self.cancel_request(peer, piece_index, begin)
+            # Replace peers that left and retry ones that failed once their back-off has passed
+            self.connection_manager.fill()
+            self.fill_requests()
+            print(f"DOWNLOADING {len(self.my_pieces)} / {self.piece_count}", end = '\r')
+            time.sleep(0.1)
+        print(f"DOWNLOADING {len(self.my_pieces)} / {self.piece_count}", end = '\r')
         print("All pieces downloaded.")
+        # Nothing left to want; peers can give our slots to someone else
+        with self.piece_has_lock:
+            peers, self.interested_in = self.interested_in, set()
+        for peer in peers:
+            self.send_interest(peer, False)
+
+    def start_metrics(self):
+        # Gauges read their values when collected, so they cost nothing in between
+        self.metrics.gauge("p2p_pieces_remaining", "Wanted pieces not verified yet", callback=self.picker.remaining)
+        self.metrics.gauge("p2p_duplicate_pieces", "Pieces received that were not needed", callback=lambda: self.dup)
+        self.metrics.gauge("p2p_duplicate_blocks", "Blocks received that were not needed", callback=lambda: self.dup_blocks)
+        self.metrics.gauge("p2p_requests_outstanding", "Block requests waiting for an answer",
+                           callback=lambda: sum(len(requested) for requested in list(self.scheduler.pending.values())))
+        self.metrics.gauge("p2p_verify_queue_depth", "Pieces waiting to be hashed or committed", callback=lambda: self.verifier.queued)
+        self.metrics.gauge("p2p_pending_haves", "Verified pieces not announced yet", callback=lambda: len(self.pending_haves))
+        self.metrics.gauge("p2p_peer_rate_bytes_per_second", "Rate each peer was ranked by at the last rechoke", ("peer",),
+                           callback=lambda: {(peer,): rate for peer, rate in dict(self.choker.rates).items()})
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+            print(f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+        if self.metrics_json:
+            threading.Thread(target=self.metrics.write_snapshots, args=(self.metrics_json, self.metrics_interval, self.exit_event)).start()
+
+    def write_stats(self, path, elapsed):
+        # Machine-readable summary of the run, read by the benchmark harness in bench/
+        usage = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+        with self.statistics_lock:
+            peers = {f"{ip}:{port}": dict(stats) for (ip, port), stats in self.peer_statistics.items()}
+        stats = {
+            "elapsed": elapsed,
+            "download_seconds": self.download_seconds,
+            "piece_count": self.piece_count,
+            "pieces": len(self.my_pieces),
+            "bytes_received": self.bytes_received,
+            "dup": self.dup,
+            "blocks_received": self.blocks_received,
+            "dup_blocks": self.dup_blocks,
+            "peers": peers,
+            "cpu_user": usage.ru_utime if usage else None,
+            "cpu_system": usage.ru_stime if usage else None,
+            "max_rss_kb": usage.ru_maxrss if usage else None,
+        }
+        # Written under a temporary name, so a reader never sees half a file
+        with open(path + ".tmp", "w") as stats_file:
+            json.dump(stats, stats_file, indent=2)
+        os.replace(path + ".tmp", path)
 
     def display_statistics(self):
         print("\n--- Statistics ---")
         print(self.dup)
-        with self.peer_list_lock:
+        with self.statistics_lock:
             for peer, stats in self.peer_statistics.items():
                 print(f"Peer {peer}: Sent: {stats['sent']}, Received: {stats['received']}")
         print("------------------")
 
-    def simu_download_pieces(self):
-        # Create a list of all pieces and shuffle it for random download order
-        piece_indices = list(range(self.piece_count))
-        if (self.random_bool):
-            random.shuffle(piece_indices)
-
-        # Limit the number of concurrent download threads to avoid overwhelming the system
-        max_concurrent_downloads = 5  # You can adjust this based on system capacity
-        active_threads = []
-
-        for piece_index in piece_indices:
-            # Skip if the piece is already downloaded
-            if piece_index in self.my_pieces:
-                continue
-
-            # Start a new thread to download this piece
-            thread = threading.Thread(target=self.download_piece_thread, args=(piece_index,))
-            thread.start()
-            active_threads.append(thread)
-
-            # Maintain a maximum number of concurrent threads
-            if len(active_threads) >= max_concurrent_downloads:
-                # Wait for any thread to finish before starting a new one
-                for t in active_threads:
-                    t.join(0.1)  # Short wait to allow threads to finish
-                    if not t.is_alive():
-                        active_threads.remove(t)
-
-        # Wait for any remaining threads to complete
-        for t in active_threads:
-            t.join()
-
-        print("SENT ALL REQUEST")
-        while len(self.downloaded_pieces) < self.piece_count:
-            not_downloaed_set = set(range(self.piece_count)) - self.my_pieces
-            time.sleep(0.5)
-            print(f"DOWNLOADING {len(self.downloaded_pieces)} / {self.piece_count}", end = '\r')
-            print(f"NOT DOWNLOADED {not_downloaed_set}")
-        print(f"DOWNLOADING {len(self.downloaded_pieces)} / {self.piece_count}", end = '\r')
-        print("All pieces downloaded.")
-
-    def download_piece_thread(self, piece_index):
-        with self.piece_has_lock:
-            # Get available peers with the required piece
-            peers_with_piece = self.piece_has.get(piece_index, [])
-        if not peers_with_piece:
-            self.log(f"No peers with piece {piece_index} available.")
-            return
-
-        # Choose a random peer and request the piece
-        peer = random.choice(peers_with_piece)
-        message = struct.pack("!IBI", 5, REQUEST, piece_index)
-        self.log(f"REQUEST PIECE {piece_index} FROM {peer}")
-        self._send_message(peer, message)
+    def create_scheduler(self, mode):
+        # Mode 0 keeps a single request outstanding per peer, mode 1 pipelines up to max_in_flight
+        with self.my_pieces_lock:
+            wanted = [index for index in range(self.piece_count) if index not in self.my_pieces]
+        self.availability = availability.Availability(self.piece_count)
+        self.picker = piece_picker.PiecePicker(self.piece_count, wanted, self.availability, self.strategy)
+        max_in_flight = 1 if mode == 0 else self.max_in_flight
+        self.scheduler = request_scheduler.RequestScheduler(self.piece_store.piece_size, max_in_flight, self.request_timeout,
+                                                            latency=self.request_latency)
+        # Received pieces are hashed off the event loop and committed in batches
+        self.verifier = verifier.Verifier(self.check_piece, self.commit_pieces, self.verify_workers)
+        print(f"Piece selection strategy: {self.strategy}")
 
-    def assemble_files(self):
-        output_folder = os.path.join(self.download_folder, self.metadata.folder_name)
-        os.makedirs(output_folder, exist_ok=True)
-        
-        piece_index = 0
-        for file_info in self.metadata.files:
-            file_name = file_info['filename']
-            file_length = file_info['length']
-            file_path = os.path.join(output_folder, file_name)
-
-            with open(file_path, 'wb') as file:
-                bytes_written = 0
-                while bytes_written < file_length:
-                    piece_data = self.downloaded_pieces[piece_index]
-                    bytes_to_write = min(len(piece_data), file_length - bytes_written)
-                    file.write(piece_data[:bytes_to_write])
-                    bytes_written += bytes_to_write
-                    piece_index += 1
-            print(f"Assembled file: {file_name}, size: {file_length}")
-    
     def quit_swarm(self):
         print("Leaving the swarm...")
         self.exit_event.set()
         
         # Notify tracker to remove this peer
-        self.tracker_socket.send(b"quit")
+        try:
+            self.tracker_socket.send(b"quit\n")
+        except OSError:
+            # The tracker is gone or we dropped it already
+            pass
         self.tracker_socket.close()
         
-        # Close all peer connections
-        with self.socket_dic_lock:
-            for peer, sock in self.socket_dic.items():
-                sock.close()
+        # Close all peer connections, then let pieces already received finish verifying
+        self.engine.stop()
+        self.verifier.close()
+        self.fast_resume.save()
+        self.fast_resume.close()
+        self.piece_store.close()
 
         print("Exited the swarm.")
 
@@ -449,40 +748,102 @@ class Leecher:
                 break
             elif user_input.lower() == "show":
                 self.display_statistics()
+            elif user_input.lower().startswith("rate"):
+                self.change_rate(user_input.split()[1:])
+
+    def change_rate(self, args):
+        # "rate <up|down|peer_up|peer_down> <bytes per second, e.g. 50M; 0 for no limit>"
+        if args:
+            try:
+                self.limiter.set_limit(args[0].lower(), rate_limit.parse_rate(args[1]))
+            except (IndexError, KeyError, ValueError):
+                print("Usage: rate <up|down|peer_up|peer_down> <bytes per second, e.g. 50M; 0 for no limit>")
+        print(f"Rate limits: {self.limiter.describe()}")
 
     
     def start(self, mode = 0):
         start = time.time()
         self.parse_torrent_file()
+        self.open_piece_store()
+        self.create_scheduler(mode)
+        self.start_metrics()
+        self.engine.start()
+        self.listen_for_incoming_connections()
+        # Pieces start arriving as soon as the tracker hands out peers
+        download_start = time.time()
         self.register_with_tracker()
-        threading.Thread(target=self.listen_for_incoming_connections).start()
         threading.Thread(target=self.input_handle).start()
+        threading.Thread(target=self.run_choker).start()
+        if self.have_interval:
+            threading.Thread(target=self.send_haves).start()
         time.sleep(1)
-        if (mode == 1):
-            self.simu_download_pieces()
-        elif (mode == 0):
-            self.download_pieces()
+        self.download_pieces()
+        self.download_seconds = (self.completed_at or time.time()) - download_start
+        # Everything is on disk, so the journal can be stamped clean
+        self.fast_resume.save()
 
-        self.assemble_files()
         #self.display_statistics()
         return (time.time() - start)
 
 
 import argparse
-import sys
 
 parser = argparse.ArgumentParser(description="Leecher in a P2P network")
 parser.add_argument("--verbose", action="store_true", help="Enable verbose logging")
-parser.add_argument("--mode", type=int, default=0, help="Mode of operation: 0 for sequential, 1 for parallel")
-parser.add_argument("--random", action="store_true", default=True, help="Enable random piece downloading")
+parser.add_argument("--mode", type=int, default=0, help="Mode of operation: 0 for one block request outstanding per peer, 1 for up to --pipeline requests per peer")
 parser.add_argument("--port", type=int, default = None, help="Port number for listening connections")
+parser.add_argument("--strategy", choices=["rarest", "random", "sequential"], default="rarest", help="Piece selection strategy")
+parser.add_argument("--pipeline", type=int, default=5, help="Outstanding requests per peer in mode 1")
+parser.add_argument("--request_timeout", type=float, default=5.0, help="Seconds before a stalled request is sent again")
+parser.add_argument("--announce_interval", type=float, default=30.0, help="Seconds between announces to the tracker")
+parser.add_argument("--endgame", type=int, default=10, help="Pieces left when outstanding requests are also sent to every other peer that has them")
+parser.add_argument("--upload_slots", type=int, default=4, help="Peers we upload to at once, plus one optimistic unchoke")
+parser.add_argument("--choke_interval", type=float, default=10.0, help="Seconds between re-rankings of the upload slots")
+parser.add_argument("--max_up", type=str, default="0", help="Upload limit in bytes per second, e.g. 50M (default: none)")
+parser.add_argument("--max_down", type=str, default="0", help="Download limit in bytes per second (default: none)")
+parser.add_argument("--peer_up", type=str, default="0", help="Upload limit per peer in bytes per second (default: none)")
+parser.add_argument("--peer_down", type=str, default="0", help="Download limit per peer in bytes per second (default: none)")
+parser.add_argument("--verify_workers", type=int, default=None, help="Threads hashing received pieces (default: one per CPU)")
+parser.add_argument("--have_interval", type=float, default=0.1, help="Seconds verified pieces are collected for before being announced in one message (0 announces at once)")
+parser.add_argument("--stats_json", type=str, default=None, help="Write timing, traffic and resource usage to this JSON file when the download finishes")
+parser.add_argument("--metrics_port", type=int, default=None, help="Serve Prometheus metrics on this local port")
+parser.add_argument("--metrics_json", type=str, default=None, help="Write a JSON snapshot of the metrics to this file periodically")
+parser.add_argument("--metrics_interval", type=float, default=10.0, help="Seconds between JSON metric snapshots")
+parser.add_argument("--max_peers", type=int, default=50, help="Most peer connections kept open, inbound and outbound")
+parser.add_argument("--dial_concurrency", type=int, default=10, help="Most connection attempts in flight at once")
+parser.add_argument("--dial_timeout", type=float, default=5.0, help="Seconds before a connection attempt is given up")
+parser.add_argument("--cache_size", type=str, default="64M", help="Memory for caching pieces we upload, e.g. 256M; 0 disables the cache")
+parser.add_argument("--read_ahead", type=int, default=4, help="Following pieces read along with a piece that missed the cache")
+parser.add_argument("--recheck", action="store_true", default=False, help="Re-verify pieces recorded in the resume journal before trusting them")
 
 args = parser.parse_args(sys.argv[1:])
 leecher = Leecher(
     torrent_file_path="file.torrent",
     download_folder="downloads",
     port=args.port,
-    random_bool=args.random,
-    print_enabled=args.verbose
+    print_enabled=args.verbose,
+    recheck=args.recheck,
+    max_in_flight=args.pipeline,
+    request_timeout=args.request_timeout,
+    strategy=args.strategy,
+    announce_interval=args.announce_interval,
+    endgame_pieces=args.endgame,
+    upload_slots=args.upload_slots,
+    choke_interval=args.choke_interval,
+    limiter=rate_limit.RateLimiter(rate_limit.parse_rate(args.max_up), rate_limit.parse_rate(args.max_down),
+                                   rate_limit.parse_rate(args.peer_up), rate_limit.parse_rate(args.peer_down)),
+    verify_workers=args.verify_workers,
+    have_interval=args.have_interval,
+    metrics_port=args.metrics_port,
+    metrics_json=args.metrics_json,
+    metrics_interval=args.metrics_interval,
+    max_peers=args.max_peers,
+    dial_concurrency=args.dial_concurrency,
+    dial_timeout=args.dial_timeout,
+    cache_size=units.parse_size(args.cache_size),
+    read_ahead=args.read_ahead
 )
-print(f"TIME ESLAPSED: {leecher.start(mode=args.mode)}")
+elapsed = leecher.start(mode=args.mode)
+print(f"TIME ESLAPSED: {elapsed}")
+if args.stats_json:
+    leecher.write_stats(args.stats_json, elapsed)
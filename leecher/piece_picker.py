@@ -0,0 +1,76 @@
+import time
+import numpy
+
+CHUNK_SIZE = 256  # Pieces checked per vector operation while walking the request order
+REORDER_INTERVAL = 0.5  # Seconds the rarest-first order may lag behind availability changes
+
+class PiecePicker:
+    # Decides which wanted piece to request next from the per-piece availability counts kept by
+    # Availability. Every wanted piece sits in a request order that is sorted once and then
+    # walked a chunk at a time, checking with vector operations whether each piece is still
+    # wanted and held by the peers asking, so a call usually touches only the first chunk or two
+    # however many pieces the torrent has. For rarest-first the order is re-sorted when
+    # availability has changed, at most every REORDER_INTERVAL. A slightly stale order only
+    # changes which piece goes first, as every check is made against the live counts.
+    # The picker has no lock of its own: callers hold the leecher's piece_has_lock.
+    def __init__(self, piece_count, wanted, availability, strategy="rarest"):
+        self.strategy = strategy
+        self.piece_count = piece_count
+        self.availability = availability
+        self.counts = availability.counts  # Number of connected peers that have each piece
+        self.wanted = numpy.zeros(piece_count, dtype=bool)
+        self.wanted[numpy.fromiter(wanted, dtype=numpy.int64)] = True
+        self.wanted_count = int(self.wanted.sum())
+
+        order = numpy.arange(piece_count)
+        if strategy != "sequential":
+            numpy.random.shuffle(order)
+        # Each piece's position in the request order. For rarest-first it breaks ties between
+        # equally rare pieces randomly, so different leechers start on different pieces.
+        self.rank = numpy.empty(piece_count, dtype=numpy.int64)
+        self.rank[order] = numpy.arange(piece_count)
+        self.order = order[self.wanted[order]]  # Wanted pieces in request order
+        self.start = 0  # Everything before this position in order is done
+        self.ordered_version = None  # Availability version the order was last sorted for
+        self.ordered_at = 0.0  # When it was
+
+    def piece_done(self, piece_index):
+        if self.wanted[piece_index]:
+            self.wanted[piece_index] = False
+            self.wanted_count -= 1
+
+    def _refresh(self):
+        # Re-sort for rarest-first once availability has changed, and drop finished pieces once
+        # they make up half of what is left to walk, but no more often than REORDER_INTERVAL
+        resort = self.strategy == "rarest" and self.ordered_version != self.availability.version
+        if not resort and len(self.order) - self.start <= 2 * self.wanted_count:
+            return
+        now = time.monotonic()
+        if now - self.ordered_at < REORDER_INTERVAL:
+            return
+        pieces = self.order[self.start:]
+        pieces = pieces[self.wanted[pieces]]
+        if self.strategy == "rarest":
+            pieces = pieces[numpy.argsort(self.counts[pieces] * self.piece_count + self.rank[pieces])]
+            self.ordered_version = self.availability.version
+        self.order = pieces
+        self.start = 0
+        self.ordered_at = now
+
+    def candidates(self, peers=None):
+        # Yield wanted pieces some peer has, in the order they should be requested.
+        # peers optionally narrows this down to the pieces those peers have.
+        self._refresh()
+        rows = None if peers is None else self.availability.rows(peers)
+        # Skip past the pieces at the front that are done
+        while self.start < len(self.order) and not self.wanted[self.order[self.start]]:
+            self.start += 1
+        for position in range(self.start, len(self.order), CHUNK_SIZE):
+            chunk = self.order[position:position + CHUNK_SIZE]
+            requestable = self.wanted[chunk] & (self.counts[chunk] > 0)
+            if rows is not None:
+                requestable &= self.availability.matrix[numpy.ix_(rows, chunk)].any(axis=0)
+            yield from chunk[requestable].tolist()
+
+    def remaining(self):
+        return self.wanted_count
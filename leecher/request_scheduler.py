@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+
+BLOCK_SIZE = 16 * 1024  # Bytes asked for by one REQUEST
+
+class RequestScheduler:
+    # Keeps a window of outstanding block REQUESTs per peer instead of flooding peers with every
+    # missing piece. Pieces are fetched as BLOCK_SIZE blocks, and the blocks of one piece are
+    # spread over every peer that has it, so a large piece is not held up by a single slow peer.
+    # A peer's window is topped up once half of it has arrived, and requests that stall
+    # for longer than request_timeout are released so they can be reissued.
+    def __init__(self, piece_size, max_in_flight=5, request_timeout=5.0, block_size=BLOCK_SIZE, latency=None):
+        self.piece_size = piece_size  # Callable returning the size of a piece
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.block_size = block_size
+        self.latency = latency  # Optional metrics histogram of seconds from REQUEST to block
+        self.pending = {}  # (piece_index, begin) -> {peer: time the request was sent}
+        self.in_flight = {}  # peer -> set of (piece_index, begin) requested from it
+        self.missing = {}  # piece_index -> begins of the blocks not received yet, for started pieces
+        # Set by the leecher once only a few pieces are left. Blocks still outstanding are then
+        # also requested from every other peer that has them, so the last pieces don't wait on
+        # a slow peer or a lost request; the duplicates are cancelled when the first copy lands.
+        self.endgame = False
+        self.lock = threading.Lock()
+
+    def next_requests(self, peers, candidates, peers_with_piece):
+        # Fill the free slots of every peer with blocks of candidate pieces it has, taking
+        # candidates in priority order and giving each block to the least-loaded peer that has it.
+        # Returns the (peer, piece_index, begin, length) blocks the caller should send REQUESTs for.
+        requests = []
+        with self.lock:
+            free = {}
+            for peer in peers:
+                room = self.max_in_flight - len(self.in_flight.get(peer, ()))
+                if room > 0:
+                    free[peer] = room
+
+            if self.endgame:
+                # Go over the last pieces twice: first for blocks nobody has been asked for,
+                # then for blocks that are outstanding with some other peer
+                candidates = list(candidates)
+                passes = (candidates, candidates)
+            else:
+                passes = (candidates,)
+            now = time.time()
+            for duplicate, pieces in enumerate(passes):
+                for piece_index in pieces:
+                    if not free:
+                        break
+                    holders = [peer for peer in peers_with_piece(piece_index) if peer in free]
+                    if not holders:
+                        continue
+                    random.shuffle(holders)
+                    if piece_index not in self.missing:
+                        self.missing[piece_index] = list(range(0, self.piece_size(piece_index), self.block_size))
+                    for begin in self.missing[piece_index]:
+                        requested = self.pending.get((piece_index, begin))
+                        if requested is None:
+                            choices = holders
+                        elif duplicate:
+                            choices = [peer for peer in holders if peer not in requested]
+                            if not choices:
+                                continue
+                        else:
+                            continue
+                        peer = max(choices, key=free.get)
+                        self.pending.setdefault((piece_index, begin), {})[peer] = now
+                        self.in_flight.setdefault(peer, set()).add((piece_index, begin))
+                        requests.append((peer, piece_index, begin, self.block_length(piece_index, begin)))
+                        free[peer] -= 1
+                        if free[peer] == 0:
+                            del free[peer]
+                            holders.remove(peer)
+                            if not holders:
+                                break
+        return requests
+
+    def needs_requests(self, peer):
+        # Whether the peer's window has drained to its low-water mark, half the window
+        with self.lock:
+            return len(self.in_flight.get(peer, ())) <= self.max_in_flight // 2
+
+    def block_length(self, piece_index, begin):
+        return min(self.block_size, self.piece_size(piece_index) - begin)
+
+    def block_received(self, piece_index, begin, length, peer):
+        # Free the request slots of the block and record it. Returns whether every block of the
+        # piece has now arrived (None if it is not a block we are still missing), and the other
+        # peers the block was requested from in endgame, whose requests can now be cancelled.
+        with self.lock:
+            requested = self._release((piece_index, begin))
+            if self.latency and peer in requested:
+                self.latency.observe(time.time() - requested[peer])
+            blocks = self.missing.get(piece_index)
+            if blocks is None or begin not in blocks or length != self.block_length(piece_index, begin):
+                return None, []
+            blocks.remove(begin)
+            return not blocks, [other for other in requested if other != peer]
+
+    def piece_checked(self, piece_index):
+        # The assembled piece was verified. If it failed, it starts again with every block missing.
+        with self.lock:
+            self.missing.pop(piece_index, None)
+
+    def expire(self):
+        # Release requests that have stalled and return them as (peer, piece_index, begin) tuples
+        with self.lock:
+            deadline = time.time() - self.request_timeout
+            expired = [(peer, piece_index, begin) for (piece_index, begin), requested in self.pending.items()
+                       for peer, sent_at in requested.items() if sent_at < deadline]
+            for peer, piece_index, begin in expired:
+                self._release_peer(peer, (piece_index, begin))
+        return expired
+
+    def drop_peer(self, peer):
+        # The peer went away, so everything requested from it has to go elsewhere
+        with self.lock:
+            for block in self.in_flight.get(peer, set()).copy():
+                self._release_peer(peer, block)
+            self.in_flight.pop(peer, None)
+
+    def _release(self, block):
+        requested = self.pending.pop(block, {})
+        for peer in requested:
+            self.in_flight[peer].discard(block)
+        return requested
+
+    def _release_peer(self, peer, block):
+        requested = self.pending.get(block)
+        if requested is not None and requested.pop(peer, None) is not None and not requested:
+            del self.pending[block]
+        self.in_flight[peer].discard(block)
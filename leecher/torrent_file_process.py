@@ -2,27 +2,29 @@
 import bencodepy
 import requests
 import bencode
+import hashlib
 
 class TorrentMetadata:
     def __init__(self, torrent_file_path):
-        data = self.decode_bencode(torrent_file_path)
+        with open(torrent_file_path, 'rb') as file:
+            bencoded_data = file.read()
+        data = bencode.decode(bencoded_data)
+        # The tracker groups peers into swarms by the SHA-1 of the bencoded info dict.
+        # bencodepy keeps the raw bytes and sorts keys, so re-encoding reproduces the original.
+        self.info_hash = hashlib.sha1(bencodepy.encode(bencodepy.decode(bencoded_data)[b'info'])).hexdigest()
         # print(data)
         self.files = data['info']['files']
         self.piece_length = data['info']['piece length']
-        #self.pieces = data['info']['pieces']
-        #self.piece_hashes = [self.pieces[i:i+20] for i in range(0, len(self.pieces), 20)]
-        self.piece_hashes = data['info']['pieces']
+        self.pieces = data['info']['pieces']
+        if isinstance(self.pieces, str):
+            # bencode hands back valid UTF-8 strings as str, so restore the raw digest bytes
+            self.pieces = self.pieces.encode('utf-8')
+        self.piece_hashes = [self.pieces[i:i+20] for i in range(0, len(self.pieces), 20)]
         self.piece_count = len(self.piece_hashes)
         self.md5sums = [file['md5sum'] for file in self.files]
         self.folder_name = data['info']['name']
         self.tracker_url = data['announce']
 
-    @staticmethod
-    def decode_bencode(file_path):
-        with open(file_path, 'rb') as file:
-            bencoded_data = file.read()
-        return bencode.decode(bencoded_data)
-
 def load_torrent_metadata(torrent_file_path):
     return TorrentMetadata(torrent_file_path)
 
@@ -0,0 +1,63 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+BATCH_SIZE = 256  # Most verified pieces committed in one go
+
+class Verifier:
+    # Hashes received pieces on a pool of threads, so SHA-1 runs on every core (hashlib releases
+    # the GIL on large buffers) and never on the event loop. Results are handed to commit in
+    # batches from a single thread: whatever finished hashing since the last commit goes in the
+    # next one, so batches grow under load without delaying pieces when the swarm is quiet.
+    def __init__(self, check, commit, workers=None, batch_size=BATCH_SIZE):
+        self.check = check  # check(piece_index, piece_data) -> whether the piece matches its hash
+        self.commit = commit  # commit([(piece_index, piece_data, peer, valid), ...])
+        self.batch_size = batch_size
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.results = queue.Queue()
+        self.queued = 0  # Pieces submitted and not yet committed
+        self.queued_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._commit_results, daemon=True)
+        self.thread.start()
+
+    def submit(self, piece_index, piece_data, peer):
+        # piece_data is None when the piece is to be hashed from disk
+        with self.queued_lock:
+            self.queued += 1
+        self.pool.submit(self._verify, piece_index, piece_data, peer)
+
+    def _verify(self, piece_index, piece_data, peer):
+        try:
+            valid = self.check(piece_index, piece_data)
+        except Exception as e:
+            # Anything else, e.g. EOFError from a short file, would be swallowed by the pool and
+            # leave the piece uncommitted for good; a failed piece is fetched again instead
+            print(f"Could not verify piece {piece_index}: {e!r}")
+            valid = False
+        self.results.put((piece_index, piece_data, peer, valid))
+
+    def _commit_results(self):
+        while True:
+            result = self.results.get()
+            batch = []
+            while result is not None:
+                batch.append(result)
+                if len(batch) == self.batch_size:
+                    break
+                try:
+                    result = self.results.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self.commit(batch)
+                with self.queued_lock:
+                    self.queued -= len(batch)
+            if result is None:
+                return
+
+    def close(self):
+        # Finish the pieces already submitted, then stop
+        self.pool.shutdown(wait=True)
+        self.results.put(None)
+        self.thread.join()
@@ -1,41 +1,80 @@
 import socket
 import threading
 import struct
-import torrent_file_process
+import os
 import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))  # Modules shared with the other components
+import torrent_file_process
+import piece_store
+import piece_cache
+import peer_wire
+import choker
+import rate_limit
+import units
+import metrics
+import super_seed
+import numpy
 
+CHOKE = 0
+UNCHOKE = 1
+INTERESTED = 2
+NOT_INTERESTED = 3
 BITFIELD = 4
 BITFIELD_NO_LOOP = 5
 REQUEST = 6
 PIECE = 7
 HAVE = 8
+BLOCK = 10
+CANCEL = 11
+HAVE_BATCH = 12
+
+MAX_BLOCK_SIZE = 128 * 1024  # Largest block we serve for a single REQUEST
 
 class Seeder:
-    def __init__(self, folder_name, piece_length, torrent_file_dest, listen_port=6882, tracker_url = 'http://localhost:8000', print_enabled=False):
+    def __init__(self, folder_name, piece_length, torrent_file_dest, listen_port=6882, tracker_url = 'http://localhost:8000', print_enabled=False,
+                 hash_workers=None, hash_cache=None, upload_slots=4, choke_interval=10.0,
+                 limiter=None, metrics_port=None, metrics_json=None, metrics_interval=10.0, super_seed_window=0,
+                 cache_size=64 << 20, read_ahead=4):
         self.folder_name = folder_name
         self.piece_length = piece_length
         self.torrent_file_dest = torrent_file_dest
+        self.hash_workers = hash_workers  # Processes used to hash the store (default: one per CPU)
+        self.hash_cache = hash_cache  # Optional file that remembers hashes of unchanged files
         self.listen_port = listen_port
         self.listen_ip = socket.gethostbyname(socket.gethostname())
         # self.tracker_ip = tracker_ip
         # self.tracker_port = tracker_port
         self.tracker_url = tracker_url
-        self.piece_map = {}  # Mapping from piece index to piece data
+        self.piece_store = None  # Reads piece data from the shared files on demand
         self.create_torrent_file()
         self.tracker_ip, self.tracker_port = torrent_file_process.get_tracker_ip_port(self.tracker_url)
         print(self.tracker_ip, self.tracker_port)
         self.exit_event = threading.Event()  # Used to signal threads to exit
-        self.client_sockets = []  # Track active connections to leechers
+        self.limiter = limiter or rate_limit.RateLimiter()  # Upload and download caps, changed with "rate"
+        self.metrics = metrics.Registry()  # Served over HTTP on metrics_port and/or written to metrics_json
+        self.metrics_port = metrics_port
+        self.metrics_json = metrics_json
+        self.metrics_interval = metrics_interval  # Seconds between JSON snapshots
+        self.engine = peer_wire.WireEngine(self, self.limiter, self.metrics)  # Serves every leecher connection from one event loop
+        # Blocks are served from a bounded cache of recently read pieces; 0 reads every block from disk
+        self.piece_cache = piece_cache.PieceCache(self.piece_store, cache_size, read_ahead, metrics=self.metrics) if cache_size else self.piece_store
         self.peer_statistics = {}  # Store statistics for sent/received messages
+        self.choker = choker.Choker(upload_slots)  # Only unchoked leechers get their requests served
+        self.choke_interval = choke_interval  # Seconds between re-rankings of the upload slots
         self.statistics_lock = threading.Lock()
+        # With a window, leechers are shown a few pieces at a time instead of the whole bitfield
+        self.super_seed = super_seed.SuperSeed(self.piece_store.piece_count, super_seed_window) if super_seed_window else None
 
         self.print_enabled = print_enabled  # Enable/disable detailed logs
 
     def create_torrent_file(self):
         # Create the torrent file and initialize the piece mapping
-        torrent_file_process.create_torrent_file(self.folder_name, self.piece_length, self.torrent_file_dest, self.tracker_url)
-        self.piece_map = torrent_file_process.get_piece_map(self.folder_name, self.piece_length)
-        self.bitfield = bytearray([1] * len(self.piece_map))  # All pieces are available
+        self.info_hash = torrent_file_process.create_torrent_file(self.folder_name, self.piece_length, self.torrent_file_dest, self.tracker_url,
+                                                 workers=self.hash_workers, hash_cache=self.hash_cache)
+        self.piece_store = piece_store.PieceStore.from_folder(self.folder_name, self.piece_length)
+        print(f"Piece store opened with {self.piece_store.piece_count} pieces, info-hash {self.info_hash}.")
+        # All pieces are available, packed one bit per piece
+        self.bitfield = peer_wire.pack_bitfield(numpy.ones(self.piece_store.piece_count, dtype=bool))
     
     def log(self, message):
         if self.print_enabled:
@@ -45,44 +84,88 @@ class Seeder:
         try:
             self.tracker_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.tracker_socket.connect((self.tracker_ip, self.tracker_port))
-            self.tracker_socket.send(str(self.listen_port).encode())
+            self.tracker_socket.send(f"{self.listen_port} {self.info_hash}\n".encode())
             self.log(f"Registered with tracker at {self.tracker_ip}:{self.tracker_port} on port {self.listen_port}")
+            threading.Thread(target=self.drain_tracker_updates).start()
         except ConnectionError:
             self.log("Failed to connect to the tracker.")
             self.tracker_socket = None
 
+    def drain_tracker_updates(self):
+        # The seeder never dials out, so peer updates from the tracker are read and dropped
+        # to keep them from piling up in the tracker's send buffer
+        try:
+            while self.tracker_socket.recv(4096):
+                pass
+        except OSError:
+            pass
+
     def deregister_from_tracker(self):
         # Inform the tracker that this seeder is leaving the swarm
         if self.tracker_socket:
             try:
-                self.tracker_socket.send(b"quit")
+                self.tracker_socket.send(b"quit\n")
                 print("Informed tracker of seeder's departure.")
             finally:
                 self.tracker_socket.close()
 
     def start_listening(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-            server_socket.bind(('', self.listen_port))
-            server_socket.listen(10)
-            server_socket.settimeout(1)
-            print(f"Seeder listening for incoming connections on port {self.listen_port}")
-
-            while not self.exit_event.is_set():
-                try:
-                    client_socket, client_address = server_socket.accept()
-                    print(f"Connected to {client_address}")
-                    self.client_sockets.append(client_socket)
-                    # Initialize statistics for the new leecher
-                    with self.statistics_lock:
-                        self.peer_statistics[client_address] = {'sent': 0, 'received': 0}
-                    threading.Thread(target=self.handle_leecher_connection, args=(client_socket, client_address)).start()
-                except socket.timeout:
-                    continue  # Timeout, check if exit_event is set
+        self.engine.start()
+        self.engine.listen(self.listen_port)
+        print(f"Seeder listening for incoming connections on port {self.listen_port}")
+        # Connections are handled on the engine's event loop; just wait here until we quit
+        self.exit_event.wait()
+        # Uploads still in flight read from the store, so it is closed only once the engine is down
+        self.engine.stop()
+        self.piece_store.close()
+
+    def peer_connected(self, client_address, outgoing):
+        print(f"Connected to {client_address}")
+        # Initialize statistics for the new leecher
+        with self.statistics_lock:
+            self.peer_statistics[client_address] = {'sent': 0, 'received': 0}
+
+    def peer_disconnected(self, client_address):
+        print(f"Closing connection to {client_address}")
+        # Hand its upload slot to someone else
+        self.apply_choke([], self.choker.remove(client_address))
+        if self.super_seed:
+            self.reveal_pieces(self.super_seed.remove_peer(client_address))
+
+    def run_choker(self):
+        # Re-rank leechers by how fast we have been uploading to them
+        while not self.exit_event.wait(self.choke_interval):
+            self.apply_choke(*self.choker.rechoke())
+
+    def apply_choke(self, choke, unchoke):
+        for peer in choke:
+            self.engine.send(peer, struct.pack("!IB", 1, CHOKE))
+            # Requests from a choked peer are discarded, including those still queued
+            self.engine.cancel_all(peer)
+            self.log(f"CHOKED {peer}")
+        for peer in unchoke:
+            self.engine.send(peer, struct.pack("!IB", 1, UNCHOKE))
+            self.log(f"UNCHOKED {peer}")
+
+    def start_metrics(self):
+        self.metrics.gauge("p2p_unchoked_peers", "Leechers currently allowed to download", callback=lambda: len(self.choker.unchoked))
+        self.metrics.gauge("p2p_peer_rate_bytes_per_second", "Rate each peer was ranked by at the last rechoke", ("peer",),
+                           callback=lambda: {(peer,): rate for peer, rate in dict(self.choker.rates).items()})
+        if self.super_seed:
+            self.metrics.gauge("p2p_super_seed_revealed_pieces", "Pieces revealed to at least one leecher",
+                               callback=self.super_seed.revealed_pieces)
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+            print(f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+        if self.metrics_json:
+            threading.Thread(target=self.metrics.write_snapshots, args=(self.metrics_json, self.metrics_interval, self.exit_event)).start()
 
     def start(self):
+        self.start_metrics()
         self.register_with_tracker()
         # Start a thread to listen for quit or show command from user
         threading.Thread(target=self.listen_for_commands).start()
+        threading.Thread(target=self.run_choker).start()
         # Start listening for leechers
         self.start_listening()
 
@@ -94,87 +177,108 @@ class Seeder:
                 print("Quitting the swarm...")
                 self.exit_event.set()
                 self.deregister_from_tracker()
-                self.close_all_connections()
                 break
             elif command.strip().lower() == "show":
                 self.display_statistics()
+            elif command.strip().lower().startswith("rate"):
+                self.change_rate(command.split()[1:])
+
+    def change_rate(self, args):
+        # "rate <up|down|peer_up|peer_down> <bytes per second, e.g. 50M; 0 for no limit>"
+        if args:
+            try:
+                self.limiter.set_limit(args[0].lower(), rate_limit.parse_rate(args[1]))
+            except (IndexError, KeyError, ValueError):
+                print("Usage: rate <up|down|peer_up|peer_down> <bytes per second, e.g. 50M; 0 for no limit>")
+        print(f"Rate limits: {self.limiter.describe()}")
+
+    def handle_message(self, client_address, message_id, data):
+        # Called on the engine's event loop for every message a leecher sends
+        if message_id == BITFIELD:  # Bitfield message
+            # Ours goes first, so pieces revealed in super-seeding arrive after it
+            self.send_bitfield(client_address)
+            self.receive_bitfield(client_address, data)
+        elif message_id == BITFIELD_NO_LOOP:
+            self.receive_bitfield(client_address, data)
+        elif message_id == INTERESTED:
+            self.apply_choke(*self.choker.set_interested(client_address, True))
+        elif message_id == NOT_INTERESTED:
+            self.apply_choke(*self.choker.set_interested(client_address, False))
+        elif message_id == REQUEST and not self.choker.is_unchoked(client_address):
+            self.log(f"IGNORED REQUEST FROM CHOKED {client_address}")
+        elif message_id == REQUEST:  # Request message
+            if len(data) == 12:
+                piece_index, begin, length = struct.unpack("!III", data)
+                self.send_piece(client_address, piece_index, begin, length)
+            else:
+                # Older leechers ask for whole pieces
+                piece_index, = struct.unpack("!I", data)
+                self.send_piece(client_address, piece_index)
+        elif message_id == CANCEL:
+            # The leecher got the block elsewhere, so drop it if it is still queued
+            piece_index, begin, length = struct.unpack("!III", data)
+            self.engine.cancel(client_address, piece_index, begin)
+            self.log(f"CANCELLED {piece_index}+{begin} FOR {client_address}")
+        elif message_id == PIECE:  # Piece message
+            piece_index = struct.unpack("!I", data[:4])[0]
+            self.log(f"DOWNLOADED {piece_index} FROM {client_address}")
+        elif message_id == HAVE:
+            piece_index, = struct.unpack("!I", data)
+            self.log(f"{client_address} has {piece_index}")
+            if self.super_seed:
+                self.reveal_pieces(self.super_seed.announced(client_address, numpy.array([piece_index], dtype=numpy.int64)))
+        elif message_id == HAVE_BATCH:
+            self.log(f"{client_address} has {len(data) // 4} more pieces")
+            if self.super_seed:
+                pieces = numpy.frombuffer(data, dtype=">u4").astype(numpy.int64)
+                self.reveal_pieces(self.super_seed.announced(client_address, pieces))
 
-    def handle_leecher_connection(self, leecher_socket, client_address):
-        try:          
-            # Continuously listen for requests for pieces
-            while not self.exit_event.is_set():
-                header = leecher_socket.recv(5)
-                if len(header) < 5:
-                    break
-                message_length, message_id = struct.unpack("!IB", header)
-                data = self._recv_exact(leecher_socket, message_length - 1)
-
-                if message_id == BITFIELD:  # Bitfield message
-                    self.receive_bitfield(leecher_socket, data)
-                    self.send_bitfield(leecher_socket)
-                elif message_id == BITFIELD_NO_LOOP:
-                    self.receive_bitfield(leecher_socket, data)
-                elif message_id == REQUEST:  # Request message
-                    piece_index, = struct.unpack("!I", data)
-                    self.send_piece(leecher_socket, piece_index, client_address)
-                elif message_id == PIECE:  # Piece message
-                    piece_index = struct.unpack("!I", data[:4])[0]
-                    piece_data = data[4:]
-                    self.log(f"DOWNLOADED {piece_index} FROM {client_address}")
-                elif message_id == HAVE:
-                    piece_index, = struct.unpack("!I", data)
-                    self.log(f"{client_address} has {piece_index}")
-
-        except (ConnectionResetError, BrokenPipeError):
-            print(f"Connection to {client_address} lost.")
-        except OSError as e:
-            print(f"Connection to {client_address} CLOSED")
-        finally:
-            print(f"Closing connection to {client_address}")
-            leecher_socket.close()
-
-    def _recv_exact(self, sock, n):
-        data = bytearray()
-        while len(data) < n:
-            packet = sock.recv(n - len(data))
-            if not packet:
-                raise ConnectionError("Connection closed unexpectedly while receiving data.")
-            data.extend(packet)
-        return data
-    
     def receive_bitfield(self, peer, bitfield):
         self.log(f"RECEIVED BD {bitfield} FROM {peer}")
+        if self.super_seed:
+            self.reveal_pieces(self.super_seed.add_peer(peer, peer_wire.unpack_bitfield(bitfield, self.piece_store.piece_count)))
 
-    def send_bitfield(self, leecher_socket):
-        message = struct.pack("!IB", 1 + len(self.bitfield), 5) + self.bitfield
-        self._send_message(leecher_socket, message)
-        self.log(f"SEND BD {message} TO {leecher_socket.getpeername()}")
-
-    def send_piece(self, leecher_socket, piece_index, client_address):
-        piece_data = self.piece_map.get(piece_index)
-        if piece_data:
-            piece_message = struct.pack("!IBI", 5 + len(piece_data), 7, piece_index) + piece_data
-            self._send_message(leecher_socket, piece_message)
-            self.log(f"SENT PIECE {piece_index} TO {client_address}.")
-            # Update statistics
-            with self.statistics_lock:
-                self.peer_statistics[client_address]['sent'] += 1
-
-    def _send_message(self, sock, message):
-        try:
-            sock.sendall(message)
-        except (BrokenPipeError, ConnectionResetError):
-            print("Failed to send message, connection may be closed.")
+    def send_bitfield(self, client_address):
+        if self.super_seed:
+            # Start the leecher on an empty bitfield, then reveal its first pieces
+            empty = peer_wire.pack_bitfield(numpy.zeros(self.piece_store.piece_count, dtype=bool))
+            self.engine.send(client_address, struct.pack("!IB", 1 + len(empty), BITFIELD_NO_LOOP) + empty)
+            return
+        message = struct.pack("!IB", 1 + len(self.bitfield), BITFIELD_NO_LOOP) + self.bitfield
+        self.engine.send(client_address, message)
+        self.log(f"SEND BD TO {client_address}")
 
-    def close_all_connections(self):
-        # Close all active leecher connections
-        for client_socket in self.client_sockets:
-            try:
-                client_socket.close()
-            except OSError:
-                pass
-        self.client_sockets.clear()
-        print("All connections closed.")
+    def reveal_pieces(self, reveals):
+        # Announce pieces to leechers one HAVE at a time, or several in a HAVE_BATCH
+        for peer, pieces in reveals.items():
+            if len(pieces) == 1:
+                message = struct.pack("!IBI", 5, HAVE, pieces[0])
+            else:
+                payload = numpy.array(pieces, dtype=">u4").tobytes()
+                message = struct.pack("!IB", 1 + len(payload), HAVE_BATCH) + payload
+            self.engine.send(peer, message)
+            self.log(f"REVEALED {pieces} TO {peer}")
+
+    def send_piece(self, client_address, piece_index, begin=None, length=None):
+        available = 0 <= piece_index < self.piece_store.piece_count
+        if available and begin is not None:
+            available = 0 < length <= MAX_BLOCK_SIZE and begin + length <= self.piece_store.piece_size(piece_index)
+        if not available:
+            self.log(f"Requested piece {piece_index} not available for {client_address}")
+            return
+        if begin is None:
+            # The engine writes the 9-byte header, then the payload: from the piece cache when it has
+            # the piece and it is smaller than SENDFILE_MIN_SIZE, otherwise with sendfile
+            header = struct.pack("!IBI", 5 + self.piece_store.piece_size(piece_index), PIECE, piece_index)
+        else:
+            # A block of the piece: the 13-byte header also carries its offset within the piece
+            header = struct.pack("!IBII", 9 + length, BLOCK, piece_index, begin)
+        self.engine.send_piece(client_address, header, self.piece_cache, piece_index, begin or 0, length)
+        self.choker.record(client_address, len(header) + (length or self.piece_store.piece_size(piece_index)))
+        self.log(f"SENT PIECE {piece_index} TO {client_address}.")
+        # Update statistics
+        with self.statistics_lock:
+            self.peer_statistics[client_address]['sent'] += 1
 
     def display_statistics(self):
         # Display the statistics for each connected peer
@@ -187,17 +291,46 @@ class Seeder:
 # Example usage
 import argparse
 
-# Add this block to handle command-line arguments
-parser = argparse.ArgumentParser(description="Run a torrent seeder.")
-parser.add_argument("--piece_length", type=int, default=2048, help="Length of each piece in bytes.")
-parser.add_argument("--port", type=int, default=6882, help="Port number for the seeder to listen on (default: 6882).")
-parser.add_argument("--verbose", action="store_true", default = False, help="Enable detailed logging.")
-args = parser.parse_args()
-
-seeder = Seeder(folder_name="store", 
-                piece_length=args.piece_length, 
-                torrent_file_dest="file.torrent", 
-                listen_port=args.port,
-                tracker_url='http://192.168.1.9:8000',
-                print_enabled=False)
-seeder.start()
\ No newline at end of file
+if __name__ == "__main__":
+    # Guarded so the hashing process pool can re-import this module safely
+    parser = argparse.ArgumentParser(description="Run a torrent seeder.")
+    parser.add_argument("--piece_length", type=int, default=2048, help="Length of each piece in bytes.")
+    parser.add_argument("--port", type=int, default=6882, help="Port number for the seeder to listen on (default: 6882).")
+    parser.add_argument("--tracker_url", type=str, default='http://192.168.1.9:8000', help="URL serving the tracker's tracker.txt.")
+    parser.add_argument("--verbose", action="store_true", default = False, help="Enable detailed logging.")
+    parser.add_argument("--workers", type=int, default=None, help="Processes used to hash the store (default: one per CPU).")
+    parser.add_argument("--upload_slots", type=int, default=4, help="Leechers served at once, plus one optimistic unchoke.")
+    parser.add_argument("--choke_interval", type=float, default=10.0, help="Seconds between re-rankings of the upload slots.")
+    parser.add_argument("--max_up", type=str, default="0", help="Upload limit in bytes per second, e.g. 50M (default: none).")
+    parser.add_argument("--max_down", type=str, default="0", help="Download limit in bytes per second (default: none).")
+    parser.add_argument("--peer_up", type=str, default="0", help="Upload limit per leecher in bytes per second (default: none).")
+    parser.add_argument("--peer_down", type=str, default="0", help="Download limit per leecher in bytes per second (default: none).")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Serve Prometheus metrics on this local port.")
+    parser.add_argument("--metrics_json", type=str, default=None, help="Write a JSON snapshot of the metrics to this file periodically.")
+    parser.add_argument("--metrics_interval", type=float, default=10.0, help="Seconds between JSON metric snapshots.")
+    parser.add_argument("--super_seed", type=int, default=0, metavar="WINDOW",
+                        help="Super-seed: reveal at most WINDOW pieces to each leecher until they spread to other peers (default: off).")
+    parser.add_argument("--cache_size", type=str, default="64M", help="Memory for caching recently served pieces, e.g. 256M; 0 disables the cache (default: 64M).")
+    parser.add_argument("--read_ahead", type=int, default=4, help="Following pieces read along with a piece that missed the cache (default: 4).")
+    parser.add_argument("--hash_cache", type=str, default=None, help="File to cache piece hashes in, keyed by path, size and mtime. Keep it outside the store folder.")
+    args = parser.parse_args()
+
+    seeder = Seeder(folder_name="store", 
+                    piece_length=args.piece_length, 
+                    torrent_file_dest="file.torrent", 
+                    listen_port=args.port,
+                    tracker_url=args.tracker_url,
+                    print_enabled=False,
+                    hash_workers=args.workers,
+                    hash_cache=args.hash_cache,
+                    upload_slots=args.upload_slots,
+                    choke_interval=args.choke_interval,
+                    limiter=rate_limit.RateLimiter(rate_limit.parse_rate(args.max_up), rate_limit.parse_rate(args.max_down),
+                                                   rate_limit.parse_rate(args.peer_up), rate_limit.parse_rate(args.peer_down)),
+                    metrics_port=args.metrics_port,
+                    metrics_json=args.metrics_json,
+                    metrics_interval=args.metrics_interval,
+                    super_seed_window=args.super_seed,
+                    cache_size=units.parse_size(args.cache_size),
+                    read_ahead=args.read_ahead)
+    seeder.start()
@@ -0,0 +1,142 @@
+import threading
+import numpy
+
+CHUNK_SIZE = 256  # Pieces checked per vector operation once every piece has been revealed
+
+class SuperSeed:
+    # Super-seeding: rather than advertising every piece, the seeder starts each leecher on an
+    # empty bitfield and reveals a few pieces at a time with HAVE, rarest in the swarm first.
+    # A piece revealed to a leecher stops counting against its window once another peer
+    # announces it, i.e. once the leecher has passed it on, so each piece tends to leave the
+    # seeder about once and the swarm copies it from there. A leecher with nobody left to pass a
+    # piece to (it is alone, or everyone else has the piece) is not held back.
+    #
+    # Announcements arrive for every HAVE, so each one only settles the leechers it concerns:
+    # the one announcing, and those a newly announced piece was pending for. New pieces come
+    # off a shuffled list of pieces nobody has seen yet, which costs about the window size per
+    # reveal. Once every piece has been out, each leecher carries on down the same list from
+    # where it stopped, so the list is walked about once per leecher in all.
+    def __init__(self, piece_count, window=8):
+        self.piece_count = piece_count
+        self.window = window  # Pieces revealed to a leecher and not yet seen elsewhere
+        self.seen = numpy.zeros(piece_count, dtype=numpy.int64)  # Leechers known to have each piece
+        self.revealed = numpy.zeros(piece_count, dtype=numpy.int64)  # Times each piece was revealed
+        self.has = {}  # peer -> bool array of the pieces it announced
+        self.pending = {}  # peer -> pieces revealed to it that have not spread yet
+        self.pending_for = {}  # piece_index -> peers it is pending for
+        self.fresh = numpy.random.permutation(piece_count)  # Pieces in the order they are first revealed
+        self.next_fresh = 0  # Everything in fresh before this was revealed or seen already
+        self.cursor = {}  # peer -> where in fresh to carry on once every piece has been revealed, None when nothing is left
+        self.lock = threading.Lock()
+
+    def add_peer(self, peer, has):
+        # The peer sent its bitfield. Returns {peer: pieces to reveal}.
+        with self.lock:
+            if peer in self.has:
+                self._drop(peer)
+            self.has[peer] = has.copy()
+            self.seen += has
+            self.pending[peer] = set()
+            # Pieces pending elsewhere that this peer turns out to have
+            affected = {owner for piece_index, owners in self.pending_for.items() if has[piece_index] for owner in owners}
+            affected.add(peer)
+            return self._settle(affected)
+
+    def remove_peer(self, peer):
+        # One fewer peer may lack a pending piece, so everyone is settled again
+        with self.lock:
+            if peer not in self.has:
+                return {}
+            self._drop(peer)
+            return self._settle(list(self.pending))
+
+    def _drop(self, peer):
+        self.seen -= self.has.pop(peer)
+        self.cursor.pop(peer, None)
+        for piece_index in self.pending.pop(peer):
+            self._unpend(peer, piece_index)
+
+    def announced(self, peer, pieces):
+        # The peer has pieces (an array of indices) from a HAVE or HAVE_BATCH
+        with self.lock:
+            has = self.has.get(peer)
+            if has is None:
+                return {}
+            pieces = numpy.unique(pieces[(pieces >= 0) & (pieces < self.piece_count)])
+            pieces = pieces[~has[pieces]]
+            if not len(pieces):
+                return {}
+            has[pieces] = True
+            self.seen[pieces] += 1
+            affected = {peer}
+            for piece_index in pieces.tolist():
+                affected.update(self.pending_for.get(piece_index, ()))
+            return self._settle(affected)
+
+    def revealed_pieces(self):
+        with self.lock:
+            return int(numpy.count_nonzero(self.revealed))
+
+    def _unpend(self, peer, piece_index):
+        owners = self.pending_for[piece_index]
+        owners.discard(peer)
+        if not owners:
+            del self.pending_for[piece_index]
+
+    def _settle(self, peers):
+        # Release the pieces of these peers that have spread and refill their windows.
+        # Returns {peer: pieces to reveal}.
+        reveals = {}
+        for peer in peers:
+            has = self.has[peer]
+            pending = self.pending[peer]
+            for piece_index in list(pending):
+                elsewhere = self.seen[piece_index] - has[piece_index]
+                if elsewhere > 0 or (has[piece_index] and self.seen[piece_index] == len(self.has)):
+                    pending.discard(piece_index)
+                    self._unpend(peer, piece_index)
+                    if self.cursor.get(peer, 0) is None and not has[piece_index]:
+                        # The peer has been offered everything else; walk again for this one
+                        self.cursor[peer] = 0
+            pieces = self._reveal(peer, has, pending)
+            for piece_index in pieces:
+                pending.add(piece_index)
+                self.pending_for.setdefault(piece_index, set()).add(peer)
+            if pieces:
+                reveals[peer] = pieces
+        return reveals
+
+    def _reveal(self, peer, has, pending):
+        room = self.window - len(pending)
+        if room <= 0:
+            return []
+        # Pieces nobody has been shown or announced yet are the rarest there are, and the peer
+        # cannot have them either. Skip the front of the list that is used up, then take from it.
+        while self.next_fresh < self.piece_count and self._used(self.fresh[self.next_fresh]):
+            self.next_fresh += 1
+        pieces = []
+        for piece_index in self.fresh[self.next_fresh:self.next_fresh + room * 4].tolist():
+            if len(pieces) == room:
+                break
+            if not self._used(piece_index):
+                pieces.append(piece_index)
+        position = self.cursor.get(peer, 0)
+        if len(pieces) < room and position is not None:
+            # Every piece has been out at least once, so walk the list from where this peer left
+            # off last time for pieces it still lacks, wrapping around once
+            self.cursor[peer] = None  # Stays None if the walk comes up short
+            for start in range(position, position + self.piece_count, CHUNK_SIZE):
+                chunk = numpy.take(self.fresh, numpy.arange(start, start + CHUNK_SIZE) % self.piece_count)
+                for offset, piece_index in zip(numpy.flatnonzero(~has[chunk]).tolist(), chunk[~has[chunk]].tolist()):
+                    if piece_index not in pending and piece_index not in pieces:
+                        pieces.append(piece_index)
+                        if len(pieces) == room:
+                            self.cursor[peer] = (start + offset + 1) % self.piece_count
+                            break
+                if len(pieces) == room:
+                    break
+        self.revealed[pieces] += 1
+        return pieces
+
+    def _used(self, piece_index):
+        return self.revealed[piece_index] or self.seen[piece_index]
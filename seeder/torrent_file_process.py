@@ -1,32 +1,32 @@
 import os
 import hashlib
 import math
+import json
 import bencodepy
+from concurrent.futures import ProcessPoolExecutor
 
-def create_torrent_file(folder_name, piece_length, torrent_file_dest, tracker_url="http://localhost:8000"):
+HASH_READ_SIZE = 1 << 20  # Bytes read per call while hashing
+
+def create_torrent_file(folder_name, piece_length, torrent_file_dest, tracker_url="http://localhost:8000", workers=None, hash_cache=None):
     files_metadata = []
-    all_piece_hashes = []
-
-    # Collect file metadata and piece hashes
-    for file_name in sorted(os.listdir(folder_name)):
-        file_path = os.path.join(folder_name, file_name)
-        if os.path.isfile(file_path):
-            file_size = os.path.getsize(file_path)
-            piece_hashes = calculate_piece_hashes(file_path, piece_length)
-            
-            all_piece_hashes.extend(piece_hashes)
-
-            file_metadata = {
-                "length": file_size,
-                "md5sum": hashlib.md5(open(file_path, 'rb').read()).hexdigest(),
-                "filename": file_name
-            }
-            files_metadata.append(file_metadata)
-
-    # Concatenate all piece hashes for bencoding
-    # pieces = b''.join(all_piece_hashes)
-    pieces = all_piece_hashes
-    # print(pieces)
+
+    file_names = [file_name for file_name in sorted(os.listdir(folder_name))
+                  if os.path.isfile(os.path.join(folder_name, file_name))]
+    file_paths = [os.path.join(folder_name, file_name) for file_name in file_names]
+
+    # The folder is one continuous byte stream split into fixed-size pieces that may span files
+    file_hashes = hash_files(file_paths, piece_length, workers, hash_cache)
+    for file_name, file_path, (_, _, _, md5sum) in zip(file_names, file_paths, file_hashes):
+        file_metadata = {
+            "length": os.path.getsize(file_path),
+            "md5sum": md5sum,
+            "filename": file_name,
+            "path": [file_name]
+        }
+        files_metadata.append(file_metadata)
+
+    # Concatenate all 20-byte piece hashes for bencoding, as standard torrents do
+    pieces = b''.join(join_piece_hashes(file_hashes, piece_length))
     # Create torrent metadata structure
     torrent_info = {
         "name": os.path.basename(folder_name),
@@ -46,36 +46,123 @@ def create_torrent_file(folder_name, piece_length, torrent_file_dest, tracker_ur
     with open(torrent_file_dest, 'wb') as torrent_file:
         torrent_file.write(encoded_data)
     print(f"Torrent file created at: {torrent_file_dest}")
+    # The tracker groups peers into swarms by the SHA-1 of the bencoded info dict
+    return hashlib.sha1(bencodepy.encode(torrent_info)).hexdigest()
 
-def calculate_piece_hashes(file_path, piece_length):
+def hash_file(file_path, piece_length, start_offset=0):
+    # Stream the file once, computing the SHA-1 of every piece that lies entirely inside it and the
+    # MD5 of the whole file. start_offset is where the file begins in the torrent's byte stream, so
+    # the bytes before its first piece boundary (head) and after its last one (tail) are returned
+    # for join_piece_hashes to combine with the neighbouring files.
     piece_hashes = []
+    md5 = hashlib.md5()
+    tail = b''
+    # Read several pieces at a time, but keep reads aligned to piece boundaries
+    read_size = max(1, HASH_READ_SIZE // piece_length) * piece_length
     with open(file_path, 'rb') as f:
+        head = f.read(-start_offset % piece_length)
+        md5.update(head)
         while True:
-            piece_data = f.read(piece_length)
-            if not piece_data:
+            data = f.read(read_size)
+            if not data:
                 break
-            piece_hash = hashlib.sha1(piece_data).hexdigest()
-            piece_hashes.append(piece_hash)
-    return piece_hashes
-
-def get_piece_map(folder_name, piece_length):
-    piece_map = {}
-    piece_index = 0
-
-    # Process each file in the folder
-    for file_name in sorted(os.listdir(folder_name)):
-        file_path = os.path.join(folder_name, file_name)
-        if os.path.isfile(file_path):
-            with open(file_path, 'rb') as f:
-                while True:
-                    piece_data = f.read(piece_length)
-                    if not piece_data:
-                        break
-                    piece_map[piece_index] = piece_data
-                    piece_index += 1
-
-    print(f"Piece map created with {len(piece_map)} pieces.")
-    return piece_map
+            md5.update(data)
+            view = memoryview(data)
+            full_length = len(data) - len(data) % piece_length
+            for start in range(0, full_length, piece_length):
+                piece_hashes.append(hashlib.sha1(view[start:start + piece_length]).digest())
+            # Only the last read can end part-way through a piece
+            tail = data[full_length:]
+    return head, piece_hashes, tail, md5.hexdigest()
+
+def read_fragments(file_path, file_size, piece_length, start_offset):
+    # Re-read just the head and tail of a file whose full-piece hashes came from the cache
+    head_length = min(-start_offset % piece_length, file_size)
+    tail_length = (file_size - head_length) % piece_length
+    with open(file_path, 'rb') as f:
+        head = f.read(head_length)
+        f.seek(file_size - tail_length)
+        tail = f.read(tail_length)
+    return head, tail
+
+def join_piece_hashes(file_hashes, piece_length):
+    # Hash the pieces that span file boundaries and merge them with each file's full-piece hashes
+    pieces = []
+    pending = bytearray()  # Data of the piece currently being assembled across files
+    for head, piece_hashes, tail, _ in file_hashes:
+        pending += head
+        if len(pending) == piece_length:
+            pieces.append(hashlib.sha1(pending).digest())
+            pending = bytearray()
+        pieces.extend(piece_hashes)
+        pending += tail
+    if pending:
+        pieces.append(hashlib.sha1(pending).digest())
+    return pieces
+
+def hash_files(file_paths, piece_length, workers=None, hash_cache=None):
+    # Hash files across a process pool, reusing cached results for files whose size and mtime are unchanged
+    cache = load_hash_cache(hash_cache) if hash_cache else {}
+    results = [None] * len(file_paths)
+    stats = [os.stat(file_path) for file_path in file_paths]
+
+    # Where each file starts in the torrent's byte stream
+    start_offsets = []
+    total_length = 0
+    for st in stats:
+        start_offsets.append(total_length)
+        total_length += st.st_size
+
+    to_hash = []
+    for i, (file_path, st) in enumerate(zip(file_paths, stats)):
+        entry = cache.get(os.path.abspath(file_path))
+        alignment = start_offsets[i] % piece_length
+        if (entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns
+                and entry["piece_length"] == piece_length and entry.get("alignment") == alignment):
+            head, tail = read_fragments(file_path, st.st_size, piece_length, start_offsets[i])
+            results[i] = (head, [bytes.fromhex(h) for h in entry["pieces"]], tail, entry["md5sum"])
+        else:
+            to_hash.append(i)
+    print(f"Hashing {len(to_hash)} files, {len(file_paths) - len(to_hash)} reused from cache.")
+
+    paths = [file_paths[i] for i in to_hash]
+    offsets = [start_offsets[i] for i in to_hash]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            hashed = list(pool.map(hash_file, paths, [piece_length] * len(paths), offsets))
+    else:
+        hashed = [hash_file(path, piece_length, offset) for path, offset in zip(paths, offsets)]
+
+    for i, result in zip(to_hash, hashed):
+        results[i] = result
+        cache[os.path.abspath(file_paths[i])] = {
+            "size": stats[i].st_size,
+            "mtime_ns": stats[i].st_mtime_ns,
+            "piece_length": piece_length,
+            "alignment": start_offsets[i] % piece_length,
+            "pieces": [h.hex() for h in result[1]],
+            "md5sum": result[3]
+        }
+
+    if hash_cache and to_hash:
+        save_hash_cache(hash_cache, cache)
+    return results
+
+def load_hash_cache(hash_cache):
+    try:
+        with open(hash_cache, 'r') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+def save_hash_cache(hash_cache, cache):
+    # Write to a temporary file first so an interrupted save never leaves a corrupt cache
+    tmp_path = hash_cache + ".tmp"
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(tmp_path, hash_cache)
 
 import requests
 def get_tracker_ip_port(tracker_url):
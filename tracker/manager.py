@@ -1,14 +1,81 @@
 # manager.py
+import argparse
+import asyncio
 import socket
-import threading
-import pickle
+import struct
+import random
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))  # Modules shared with the other components
+import peer_list
+
+# Frames sent to peers: 4-byte length, 1-byte type, compact peer list (see peer_list.py)
+FULL = 1  # Every peer in the swarm
+SAMPLE = 2  # A bounded random subset of the swarm
+JOIN = 3  # Peers that just joined
+LEAVE = 4  # Peers that just left
+
+SAMPLE_SIZE = 50  # Peers handed out per join or announce in delta mode
+MAX_BUFFERED = 256 * 1024  # Bytes queued for a peer before we stop sending it updates
+
+class Swarm:
+    # Peers sharing one torrent, identified by the SHA-1 of its bencoded info dict
+    def __init__(self, info_hash):
+        self.info_hash = info_hash
+        self.active_peers = {}  # peer_entry -> StreamWriter of its tracker connection
+        # Dense list of the same peers so random samples cost O(sample_size) rather than O(N)
+        self.peer_order = []
+        self.peer_position = {}  # peer_entry -> index in peer_order
+        self.stats = {'joined': 0, 'left': 0, 'announces': 0, 'dropped_updates': 0}
+
+    def add(self, peer_entry, writer):
+        old_writer = self.active_peers.get(peer_entry)
+        if old_writer:
+            # The peer reconnected before we noticed the old connection drop
+            old_writer.close()
+        else:
+            self.peer_position[peer_entry] = len(self.peer_order)
+            self.peer_order.append(peer_entry)
+        self.active_peers[peer_entry] = writer
+        self.stats['joined'] += 1
+
+    def remove(self, peer_entry, writer):
+        # Only the connection that currently owns the entry may remove it
+        if self.active_peers.get(peer_entry) is not writer:
+            return False
+        del self.active_peers[peer_entry]
+        # Swap the last peer into the freed slot to keep peer_order dense
+        position = self.peer_position.pop(peer_entry)
+        last_entry = self.peer_order.pop()
+        if last_entry != peer_entry:
+            self.peer_order[position] = last_entry
+            self.peer_position[last_entry] = position
+        self.stats['left'] += 1
+        return True
+
+    def sample(self, peer_entry, sample_size):
+        # Up to sample_size random peers other than peer_entry
+        count = min(sample_size + 1, len(self.peer_order))
+        peers = [self.peer_order[index] for index in random.sample(range(len(self.peer_order)), count)]
+        return [peer for peer in peers if peer != peer_entry][:sample_size]
+
+    def name(self):
+        return self.info_hash[:8] or "default"
 
 class Tracker:
-    def __init__(self, port=5008):
+    # Peers connect, send their listening port and the info-hash of their torrent on one line and
+    # keep the connection open; "announce" asks for a fresh sample and "quit" leaves the swarm.
+    # Each info-hash has its own Swarm, so peers only ever hear about peers sharing the same
+    # torrent. All peers are served from one asyncio event loop, so a slow peer never blocks the others.
+    #
+    # In "full" mode every join or leave sends the whole peer list to every peer, which is O(N^2)
+    # bytes per churn event. In "delta" mode a new peer gets a random sample of at most
+    # sample_size peers and everyone else only gets a JOIN or LEAVE frame for the peer that changed.
+    def __init__(self, port=5008, mode="delta", sample_size=SAMPLE_SIZE):
         self.port = port
-        self.active_peers = []
-        self.peer_sockets = {}
-        self.lock = threading.Lock()
+        self.mode = mode
+        self.sample_size = sample_size
+        self.swarms = {}  # info_hash -> Swarm
 
         # Write tracker IP and port to tracker.txt at initialization
         self.write_tracker_info()
@@ -22,71 +89,103 @@ class Tracker:
 
     def start(self):
         # Start the tracker to listen for incoming peer connections
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(('', self.port))
-        server_socket.listen(10)
-        print(f"Tracker running on port {self.port}")
-
-        while True:
-            client_socket, client_address = server_socket.accept()
-            threading.Thread(target=self.handle_peer, args=(client_socket, client_address)).start()
-
-    def handle_peer(self, peer_socket, peer_address):
-        # Register a peer and update active peer list
-        print("HERE")
-        message = peer_socket.recv(1024).decode()
-        print(f"{peer_address} MS: {message}")
-        try:
-            peer_port = int(message)
-            peer_entry = (peer_address[0], peer_port)
+        asyncio.run(self.serve())
 
-            with self.lock:
-                self.active_peers.append(peer_entry)
-                self.peer_sockets[peer_entry] = peer_socket
-            print("OK")
-            # Broadcast updated peer list to all connected peers
-            self.broadcast_peer_list()
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_peer, '', self.port)
+        print(f"Tracker running on port {self.port} in {self.mode} mode")
+        async with server:
+            await server.serve_forever()
 
-            # Listen for 'quit' message to handle peer disconnection
+    async def handle_peer(self, reader, writer):
+        # Register a peer and serve its announces until it quits or disconnects
+        peer_address = writer.get_extra_info('peername')
+        try:
+            message = (await reader.readline()).decode().split()
+            peer_entry = (peer_address[0], int(message[0]))
+            # Peers that don't send an info-hash all share the default swarm
+            info_hash = message[1].lower() if len(message) > 1 else ""
+        except (ValueError, IndexError, ConnectionError):
+            print(f"ERROR WHEN RECEIVING MESSAGE FROM {peer_address}")
+            writer.close()
+            return
+
+        swarm = self.swarms.get(info_hash)
+        if swarm is None:
+            swarm = self.swarms[info_hash] = Swarm(info_hash)
+            print(f"Swarm {swarm.name()} created ({len(self.swarms)} swarms)")
+        self.add_peer(swarm, peer_entry, writer)
+        try:
             while True:
-                try:
-                    data = peer_socket.recv(1024).decode()
-                    if data == "quit":
-                        self.remove_peer(peer_entry)
-                        break
-                except OSError as e:
-                    print(f"CONNECTION TO {peer_entry} CLOSED")
-                    self.remove_peer(peer_entry)
+                command = (await reader.readline()).strip()
+                if not command or command == b"quit":
                     break
-        except :
-            print("ERROR WHEN RECEIVING MESSAGE FROM PEER")
-            pass
-
-    
-    def remove_peer(self, peer_entry):
-        # Remove peer and update all other peers
-        with self.lock:
-            if peer_entry in self.active_peers:
-                self.active_peers.remove(peer_entry)
-                if peer_entry in self.peer_sockets:
-                    self.peer_sockets[peer_entry].close()
-                    del self.peer_sockets[peer_entry]
-                print(f"Peer {peer_entry} left the swarm")
-
-        # Broadcast updated peer list
-        self.broadcast_peer_list()
-
-    def broadcast_peer_list(self):
-        # Send the active peer list to all connected peers
-        print(f"UPDATED PEER LIST {self.active_peers}")
-        peer_data = pickle.dumps(self.active_peers)
-        with self.lock:
-            for peer, socket in self.peer_sockets.items():
-                try:
-                    socket.sendall(peer_data)
-                except (BrokenPipeError, ConnectionResetError):
-                    print(f"Failed to send peer list to {peer}.")
+                if command == b"announce":
+                    swarm.stats['announces'] += 1
+                    self.send_frame(swarm, peer_entry, writer, SAMPLE, swarm.sample(peer_entry, self.sample_size))
+        except (ConnectionError, OSError):
+            print(f"CONNECTION TO {peer_entry} CLOSED")
+        finally:
+            self.remove_peer(swarm, peer_entry, writer)
+
+    def add_peer(self, swarm, peer_entry, writer):
+        swarm.add(peer_entry, writer)
+        print(f"Peer {peer_entry} joined swarm {swarm.name()} ({len(swarm.active_peers)} peers)")
+
+        if self.mode == "full":
+            self.broadcast_peer_list(swarm)
+        else:
+            self.send_frame(swarm, peer_entry, writer, SAMPLE, swarm.sample(peer_entry, self.sample_size))
+            self.broadcast(swarm, JOIN, [peer_entry], exclude=peer_entry)
+
+    def remove_peer(self, swarm, peer_entry, writer):
+        writer.close()
+        if not swarm.remove(peer_entry, writer):
+            return
+        print(f"Peer {peer_entry} left swarm {swarm.name()} ({len(swarm.active_peers)} peers)")
+
+        if not swarm.active_peers:
+            # Nobody is sharing this torrent any more
+            del self.swarms[swarm.info_hash]
+            print(f"Swarm {swarm.name()} closed, stats: {swarm.stats}")
+        elif self.mode == "full":
+            self.broadcast_peer_list(swarm)
+        else:
+            self.broadcast(swarm, LEAVE, [peer_entry])
+
+    def broadcast_peer_list(self, swarm):
+        # Send the swarm's peer list to all of its peers
+        self.broadcast(swarm, FULL, list(swarm.active_peers))
+
+    def broadcast(self, swarm, frame_type, peers, exclude=None):
+        # Encode once and queue the same frame for every peer in the swarm
+        frame = self.encode_frame(frame_type, peers)
+        for peer, writer in swarm.active_peers.items():
+            if peer != exclude:
+                self.write_frame(swarm, peer, writer, frame)
+
+    def send_frame(self, swarm, peer, writer, frame_type, peers):
+        self.write_frame(swarm, peer, writer, self.encode_frame(frame_type, peers))
+
+    def encode_frame(self, frame_type, peers):
+        payload = peer_list.encode_peers(peers)
+        return struct.pack("!IB", 1 + len(payload), frame_type) + payload
+
+    def write_frame(self, swarm, peer, writer, frame):
+        # writes never block the loop; a peer that stops reading just misses updates
+        # until it drains its backlog, and can catch up with its next announce
+        if writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+            swarm.stats['dropped_updates'] += 1
+            print(f"Failed to send peer list to {peer}.")
+            return
+        writer.write(frame)
 
 if __name__ == "__main__":
-    tracker = Tracker()
+    parser = argparse.ArgumentParser(description="Run the swarm tracker.")
+    parser.add_argument("--port", type=int, default=5008, help="Port number for the tracker to listen on (default: 5008).")
+    parser.add_argument("--mode", choices=["delta", "full"], default="delta", help="Send peers a random sample plus join/leave deltas, or the full list on every change.")
+    parser.add_argument("--sample_size", type=int, default=SAMPLE_SIZE, help="Peers handed out per join or announce in delta mode.")
+    args = parser.parse_args()
+
+    tracker = Tracker(port=args.port, mode=args.mode, sample_size=args.sample_size)
     tracker.start()